@@ -0,0 +1,76 @@
+"""
+Byte classes shared by the attacks that judge whether a candidate PT looks
+like English (challenges 3, 12, 19 and 27). Every byte value is classified
+once into a 256-entry table, so scoring and plausibility checks are table
+lookups that work on whole batches of candidates at once.
+
+The challenge scripts append this directory to the end of sys.path (so
+misc/base64.py never shadows the standard library) and import from here.
+"""
+
+import numpy as np
+
+# Byte classes, from most to least likely to appear in an English PT
+COMMON = 0  # Lowercase letters and spaces
+NEUTRAL = 1 # Every other byte not below (printable ASCII, tabs, newlines)
+RARE = 2    # Rarely used characters: 128, 153, 161-255
+UNUSED = 3  # Unused characters: 0-8, 11-31, 127, 129-152, 154-160
+
+def byte_classes():
+    """
+    @returns [np.array]: The class (COMMON, NEUTRAL, RARE or UNUSED) of every
+                         byte, indexed by byte value
+    """
+
+    classes = np.empty(256, dtype=np.uint8)
+    classes[:] = NEUTRAL
+    classes[[ord(' ')] + range(ord('a'), ord('a')+26)] = COMMON
+    classes[[128] + [153] + range(161, 256)] = RARE
+    classes[range(0, 9) + range(11, 32) + [127] + range(129, 153)
+            + range(154, 161)] = UNUSED
+    return classes
+
+BYTE_CLASSES = byte_classes()
+CLASS_SCORES = np.array([1, 0, -9, -99]) # Score of a byte in each class
+IMPLAUSIBLE = ''.join(chr(i) for i in range(256) if BYTE_CLASSES[i] >= RARE)
+
+def is_plausible(buf):
+    """
+    @param buf [str]: Candidate PT
+    @returns [bool]: True if @buf has no RARE or UNUSED bytes. Deleting them
+                     with str.translate() runs at memory speed.
+    """
+
+    return len(buf.translate(None, IMPLAUSIBLE)) == len(buf)
+
+def count_classes(buf):
+    """
+    @param buf [str]: Candidate PT
+    @returns [np.array]: Number of bytes of @buf in each class
+    """
+
+    return np.bincount(np.take(BYTE_CLASSES, np.frombuffer(buf, np.uint8)),
+                       minlength=len(CLASS_SCORES))
+
+def count_classes_batch(bufs):
+    """
+    @param bufs [list]: Candidate PTs
+    @returns [np.array]: (|@bufs| x 4) matrix of the number of bytes of each
+                         candidate in each class
+    """
+
+    nclasses = len(CLASS_SCORES)
+    rows = np.repeat(np.arange(len(bufs)), map(len, bufs))
+    classes = np.take(BYTE_CLASSES, np.frombuffer(''.join(bufs), np.uint8))
+    return np.bincount(rows * nclasses + classes,
+                       minlength=len(bufs) * nclasses
+                       ).reshape(len(bufs), nclasses)
+
+def is_plausible_batch(bufs):
+    """
+    @param bufs [list]: Candidate PTs
+    @returns [np.array]: Boolean array, True for each candidate with no RARE
+                         or UNUSED bytes
+    """
+
+    return count_classes_batch(bufs)[:, RARE:].sum(axis=1) == 0
@@ -0,0 +1,118 @@
+"""
+Checkpointing for long-running oracle attacks (challenges 12 and 17). An
+attack keeps its progress in an AttackState and counts its oracle queries
+through it; the state is saved to disk every so often, and an interrupted
+attack loads it back and resumes after the last byte it recovered.
+"""
+
+import json
+import os
+import tempfile
+
+class AttackState:
+    """
+    Progress of a long-running oracle attack, so that an interrupted attack
+    can pick up exactly where it stopped:
+        target: Identifies what is being attacked (e.g. the hex CT being
+                decrypted), so a checkpoint isn't resumed against the wrong
+                target
+        recovered: Bytes recovered so far
+        blockidx: Index of the block being attacked
+        byteidx: Index of the byte being attacked within that block
+        block: Modified CT block that last got a positive answer from the
+               oracle, if the attack uses one
+        queries: Oracle queries made so far
+    The attack updates the fields after each byte it recovers and calls
+    query() for every oracle query it makes. If the state has a @path, it's
+    saved there every @interval queries. Saving writes a temporary file in
+    the same directory and renames it over @path, so an interruption leaves
+    either the old checkpoint or the new one, never a partially written one.
+    """
+
+    def __init__(self, path=None, interval=1000):
+        """
+        @param path [str]: Checkpoint file path (the state isn't saved if not
+                           given)
+        @param interval [int]: Number of queries between checkpoints
+        """
+
+        self.path = path
+        self.interval = interval
+        self.target = None
+        self.recovered = ''
+        self.blockidx = 0
+        self.byteidx = 0
+        self.block = None
+        self.queries = 0
+        self.__saved = 0 # Queries made when the state was last saved
+
+    @classmethod
+    def load(cls, path, interval=1000):
+        """
+        @param path [str]: Checkpoint file path
+        @param interval [int]: Number of queries between checkpoints
+        @returns [AttackState]: The state saved at @path, or a new state that
+                                will be saved there if there isn't one
+        """
+
+        state = cls(path, interval)
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            state.target = saved['target']
+            state.recovered = saved['recovered'].decode('hex')
+            state.blockidx = saved['blockidx']
+            state.byteidx = saved['byteidx']
+            state.block = (saved['block'].decode('hex')
+                           if saved['block'] is not None else None)
+            state.queries = state.__saved = saved['queries']
+        return state
+
+    def resume(self, target):
+        """
+        Claims the state for @target, or checks that a loaded state was saved
+        by an attack on @target.
+
+        @param target [str]: Identifies what is being attacked
+        """
+
+        if self.target is None:
+            self.target = target
+        elif self.target != target:
+            raise Exception('Checkpoint %s is for a different target.'
+                            % self.path)
+
+    def query(self, n=1):
+        """
+        Counts @n oracle queries and saves the state if @interval queries have
+        been made since it was last saved.
+
+        @param n [int]: Number of queries made
+        """
+
+        self.queries += n
+        if self.path and self.queries - self.__saved >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Writes the state to @path as JSON.
+        """
+
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path))
+        )
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'target': self.target,
+                'recovered': self.recovered.encode('hex'),
+                'blockidx': self.blockidx,
+                'byteidx': self.byteidx,
+                'block': (self.block.encode('hex')
+                          if self.block is not None else None),
+                'queries': self.queries
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, self.path)
+        self.__saved = self.queries
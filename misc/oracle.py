@@ -0,0 +1,193 @@
+"""
+Instrumentation for the oracles used throughout the challenges (the
+SessionOracle and Webserver classes). Wrapping an oracle in an
+InstrumentedOracle records how many times each method is called, how many
+bytes go in and out, how long each call takes and how many calls repeat an
+earlier query. Deterministic methods can optionally be memoized so repeated
+queries never reach the underlying oracle. This is meant for costing attacks
+before running them against slow oracles.
+"""
+
+import collections
+import json
+import math
+import os
+import sys
+import threading
+import timeit
+
+def payload_size(obj):
+    """
+    Returns the number of bytes in an oracle argument or result. Strings count
+    their length, tuples and lists count the sum of their elements and
+    anything else (bools, ints, None) counts as 0.
+
+    @param obj [object]: Argument or return value of an oracle method
+    @returns [int]: Number of bytes
+    """
+
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(map(payload_size, obj))
+    return 0
+
+class InstrumentedOracle:
+    """
+    Wraps an oracle object and instruments every public method call made
+    through the wrapper. Non-callable attributes (e.g. SessionOracle.PREFIX)
+    are passed through untouched, so the wrapper can be used anywhere the
+    original oracle is used.
+
+    Latencies are bucketed into a power-of-two histogram of microseconds,
+    where the bucket '<2^k' counts the calls that took less than 2^k us.
+
+    Methods named in @memoize are cached in an LRU of at most @cachesize
+    results. Only memoize methods that are deterministic for the lifetime of
+    the oracle (e.g. challenge 12's encrypt or challenge 17's valid_padding,
+    but not challenge 17's choose_random_string).
+
+    Duplicates are counted against an LRU of the last @cachesize distinct
+    queries (to any method), so memory stays bounded on long attacks and a
+    query repeated after that many others counts as new. Queries with
+    unhashable arguments (e.g. a bytearray, or the list of calls of a
+    RemoteOracle batch) are neither memoized nor checked for duplicates.
+
+    The wrapper can be shared by threads: the bookkeeping is done under a
+    lock, but calls to the oracle run concurrently.
+    """
+
+    def __init__(self, oracle, memoize=(), cachesize=65536):
+        """
+        @param oracle [object]: The oracle to wrap
+        @param memoize [list]: Names of deterministic methods to memoize
+        @param cachesize [int]: Maximum number of memoized results (and of
+                                remembered queries)
+        """
+
+        self.__oracle = oracle
+        self.__memoize = set(memoize)
+        self.__cachesize = cachesize
+        self.__cache = collections.OrderedDict() # { key: result } in LRU order
+        self.__evictions = 0
+        self.__seen = collections.OrderedDict() # { key: None } in LRU order
+        self.__stats = {}  # { method name: stats dict }
+        self.__lock = threading.Lock() # Guards everything above
+
+    def __getattr__(self, name):
+        attr = getattr(self.__oracle, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def instrumented(*args, **kwargs):
+            return self.__call(name, attr, args, kwargs)
+
+        return instrumented
+
+    def __method_stats(self, name):
+        if name not in self.__stats:
+            self.__stats[name] = {
+                'calls': 0,        # Calls made through the wrapper
+                'oracle_calls': 0, # Calls that reached the oracle
+                'cache_hits': 0,
+                'duplicates': 0,   # Calls repeating a remembered query
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'latency_total': 0.0,
+                'latency_max': 0.0,
+                'latency_histogram': collections.Counter()
+            }
+        return self.__stats[name]
+
+    def __call(self, name, method, args, kwargs):
+        """
+        Calls @method on the wrapped oracle (or returns the memoized result)
+        and records the call.
+        """
+
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = None # Unhashable, so not tracked (see the class docstring)
+        with self.__lock:
+            stats = self.__method_stats(name)
+            stats['calls'] += 1
+            stats['bytes_sent'] += (payload_size(args)
+                                    + payload_size(kwargs.values()))
+            if key is not None:
+                if key in self.__seen:
+                    stats['duplicates'] += 1
+                    del self.__seen[key] # Move to the most recently used end
+                self.__seen[key] = None
+                if len(self.__seen) > self.__cachesize:
+                    self.__seen.popitem(last=False)
+
+            if (name in self.__memoize and key is not None
+                    and key in self.__cache):
+                result = self.__cache.pop(key)
+                self.__cache[key] = result # Move to the most recently used end
+                stats['cache_hits'] += 1
+                stats['bytes_received'] += payload_size(result)
+                return result
+
+        start = timeit.default_timer()
+        result = method(*args, **kwargs)
+        latency = timeit.default_timer() - start
+
+        bucket = max(0, int(math.ceil(math.log(max(latency * 1e6, 1), 2))))
+        with self.__lock:
+            stats['oracle_calls'] += 1
+            stats['bytes_received'] += payload_size(result)
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['latency_histogram']['<2^%d' % bucket] += 1
+
+            if name in self.__memoize and key is not None:
+                self.__cache[key] = result
+                if len(self.__cache) > self.__cachesize:
+                    self.__cache.popitem(last=False) # Evict the least
+                    self.__evictions += 1            # recently used result
+        return result
+
+    def stats(self):
+        """
+        @returns [dict]: Mapping of { method name: stats dict } for every
+                         method called through the wrapper, plus the cache
+                         state under the key 'cache'.
+        """
+
+        report = {}
+        with self.__lock:
+            for name, stats in self.__stats.iteritems():
+                histogram = dict(stats['latency_histogram'])
+                report[name] = dict(stats, latency_histogram=histogram)
+                report[name]['latency_mean'] = (
+                    stats['latency_total'] / stats['oracle_calls']
+                    if stats['oracle_calls'] else 0.0
+                )
+            report['cache'] = {
+                'memoized': sorted(self.__memoize),
+                'size': len(self.__cache),
+                'capacity': self.__cachesize,
+                'evictions': self.__evictions
+            }
+        return report
+
+    def report(self):
+        """
+        @returns [str]: JSON report of stats()
+        """
+
+        return json.dumps(self.stats(), indent=2, sort_keys=True)
+
+if __name__=='__main__':
+    # Cost the challenge 12 attack. Replace (rather than extend) this
+    # directory on the path so misc/base64.py doesn't shadow the standard
+    # library module that the cryptography package imports.
+    sys.path[0] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'set2')
+    from challenge12 import SessionOracle, decrypt_session_secret
+    oracle = InstrumentedOracle(SessionOracle(), memoize=['encrypt'])
+    print decrypt_session_secret(oracle)[0]
+    print oracle.report()
@@ -0,0 +1,607 @@
+"""
+A local stand-in for remote oracles. One server process hosts the session
+oracles of challenges 12, 14, 16, 17, 25, 26 and 27 by name, over HTTP on a
+TCP port or on a Unix socket, with artificial latency, jitter and per-session
+rate limits, so attacks can be benchmarked against realistic network costs.
+
+Every session gets its own oracle instance (and so its own random key). The
+protocol is JSON over HTTP/1.1 with keep-alive, with strings sent as
+{"hex": ...} so binary data survives:
+    GET  /                           Names of the hosted oracles
+    GET  /[name]/[session]           Public methods and attributes of the
+                                     session's oracle
+    POST /[name]/[session]/[method]  {"args": [...]} -> {"result": ...} or
+                                     {"error": ...}
+    POST /[name]/[session]/batch     {"method": ..., "calls": [[...], ...]}
+                                     -> {"results": [...]}, one result or
+                                     error for each call
+A batch pays the latency once and the rate limit once per call.
+
+RemoteOracle has the same methods and attributes as the oracle it stands for,
+so attack code takes either one. open_oracle() picks between them from an
+address (e.g. from the environment), so switching needs no code changes:
+    oracle = open_oracle(os.environ.get('ORACLE_ADDRESS'), 'challenge12')
+    decrypt_session_secret(oracle)
+"""
+
+import os
+import sys
+
+# When run as a script, this directory comes first on the path, and
+# misc/base64.py would shadow the standard library module (which httplib and
+# the cryptography package import), so move it to the end (where the
+# challenge scripts that import this module put it) and put the challenge
+# directories on the path too.
+MISC_DIR = os.path.dirname(os.path.abspath(__file__))
+SET_DIRS = [os.path.join(MISC_DIR, '..', 'set%d' % i) for i in (2, 3, 4)]
+sys.path = ([path for path in sys.path
+             if os.path.abspath(path or '.') != MISC_DIR]
+            + [MISC_DIR]
+            + [path for path in SET_DIRS if path not in sys.path])
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import httplib
+import importlib
+import json
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+ORACLES = {
+    'challenge12': ('challenge12', 'SessionOracle'),
+    'challenge14': ('challenge14', 'SessionOracle'),
+    'challenge16': ('challenge16', 'SessionOracle'),
+    'challenge17': ('challenge17', 'Webserver'),
+    'challenge25': ('challenge25', 'SessionOracle'),
+    'challenge26': ('challenge26', 'SessionOracle'),
+    'challenge27': ('challenge27', 'SessionOracle')
+}
+
+def oracle_class(name):
+    """
+    @param name [str]: Oracle name (a key of ORACLES)
+    @returns [class]: The oracle's class
+    """
+
+    if name not in ORACLES:
+        raise Exception('Unknown oracle %s.' % name)
+    module, cls = ORACLES[name]
+    return getattr(importlib.import_module(module), cls)
+
+def public_interface(oracle):
+    """
+    @param oracle [object]: Oracle instance
+    @returns [tuple]: ([list], [dict]), where t[0] is the names of the
+                      oracle's public methods and t[1] is a mapping of
+                      { name: value } of its public string attributes (e.g.
+                      challenge 16's PREFIX).
+    """
+
+    methods, attributes = [], {}
+    for name in dir(oracle):
+        if name.startswith('_'):
+            continue
+        attr = getattr(oracle, name)
+        if callable(attr):
+            methods.append(name)
+        elif isinstance(attr, str):
+            attributes[name] = attr
+    return (sorted(methods), attributes)
+
+def encode(obj):
+    """
+    Encodes an oracle argument or result for JSON. Strings are binary, so
+    they're hex encoded as {"hex": ...}, and tuples become lists.
+    """
+
+    if isinstance(obj, str):
+        return {'hex': obj.encode('hex')}
+    if isinstance(obj, (tuple, list)):
+        return map(encode, obj)
+    return obj
+
+def decode(obj):
+    """
+    Inverse of encode() (except that lists stay lists).
+    """
+
+    if isinstance(obj, dict) and 'hex' in obj:
+        return str(obj['hex']).decode('hex')
+    if isinstance(obj, list):
+        return map(decode, obj)
+    return obj
+
+def well_formed(method, body):
+    """
+    @param method [str]: Method name from the request path ('batch' for a
+                         batch request)
+    @param body [object]: Decoded JSON request body
+    @returns [bool]: True if @body has the fields a call to @method needs
+    """
+
+    if not isinstance(body, dict):
+        return False
+    if method == 'batch':
+        calls = body.get('calls')
+        return (isinstance(body.get('method'), basestring)
+                and re.match(r'[A-Za-z_]\w*$', body['method']) is not None
+                and isinstance(calls, list)
+                and all(isinstance(args, list) for args in calls))
+    return isinstance(body.get('args', []), list)
+
+class OracleServer:
+    """
+    Hosts a session oracle for each (name, session) pair, created on first
+    use. Every call sleeps for @latency plus a uniformly random extra of up
+    to @jitter seconds, and calls to each session are throttled to @rate per
+    second (unlimited if None).
+    """
+
+    def __init__(self, latency=0, jitter=0, rate=None):
+        """
+        @param latency [float]: Seconds added to every request
+        @param jitter [float]: Maximum random seconds added on top of
+                               @latency
+        @param rate [float]: Maximum calls per second to each session
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.__lock = threading.Lock()
+        self.__sessions = {}   # { (name, session): oracle instance }
+        self.__next_start = {} # { (name, session): earliest next call time }
+
+    def session(self, name, session):
+        """
+        @returns [object]: The oracle instance for @session of @name
+        """
+
+        key = (name, session)
+        with self.__lock:
+            if key not in self.__sessions:
+                self.__sessions[key] = oracle_class(name)()
+                self.__next_start[key] = 0
+            return self.__sessions[key]
+
+    def delay(self, name, session, calls=1):
+        """
+        Sleeps for the request's latency and until the session's rate limit
+        allows @calls more calls.
+        """
+
+        wait = self.latency + random.uniform(0, self.jitter)
+        if self.rate:
+            key = (name, session)
+            with self.__lock:
+                now = time.time()
+                start = max(now, self.__next_start[key])
+                self.__next_start[key] = start + float(calls) / self.rate
+            wait += start - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def call(self, name, session, method, args):
+        """
+        @returns [dict]: {'result': ...} or {'error': ...} (encoded)
+        """
+
+        oracle = self.session(name, session)
+        if method.startswith('_') or not callable(getattr(oracle, method,
+                                                          None)):
+            return {'error': encode('Unknown method %s.' % method)}
+        try:
+            return {'result': encode(getattr(oracle, method)(*decode(args)))}
+        except Exception, e:
+            return {'error': encode(e.message)}
+
+    def handle(self, verb, path, body):
+        """
+        Handles a request (see the module docstring for the endpoints).
+
+        @param verb [str]: 'GET' or 'POST'
+        @param path [str]: Request path
+        @param body [object]: Decoded JSON request body (None for GET)
+        @returns [tuple]: ([int], [object]), where t[0] is the HTTP status and
+                          t[1] is the JSON response
+        """
+
+        parts = [part for part in path.split('/') if part]
+        if verb == 'GET' and not parts:
+            return (200, sorted(ORACLES))
+        if len(parts) < 2 or parts[0] not in ORACLES:
+            return (404, {'error': encode('Unknown oracle.')})
+        name, session = parts[:2]
+        if verb == 'GET' and len(parts) == 2:
+            methods, attributes = public_interface(self.session(name,
+                                                                session))
+            return (200, {'methods': methods,
+                          'attributes': encode(attributes.items())})
+        if verb == 'POST' and len(parts) == 3:
+            if not well_formed(parts[2], body):
+                return (400, {'error': encode('Malformed request body.')})
+            self.session(name, session)
+            if parts[2] == 'batch':
+                self.delay(name, session, len(body['calls']))
+                return (200, {'results': [
+                    self.call(name, session, body['method'], args)
+                    for args in body['calls']
+                ]})
+            self.delay(name, session)
+            return (200, self.call(name, session, parts[2],
+                                   body.get('args', [])))
+        return (404, {'error': encode('Unknown endpoint.')})
+
+class OracleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the endpoints of an OracleServer (self.server.oracle) over HTTP/1.1
+    with keep-alive.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # Send the headers and body together (see challenge 17)
+
+    def __respond(self, verb):
+        body = None
+        try:
+            if verb == 'POST':
+                length = int(self.headers.getheader('Content-Length', 0))
+                body = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.close_connection = 1 # The body may not have been read
+            status, response = (400, {'error': encode('Malformed JSON.')})
+        else:
+            status, response = self.server.oracle.handle(verb, self.path,
+                                                         body)
+        response = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        self.__respond('GET')
+
+    def do_POST(self):
+        self.__respond('POST')
+
+    def address_string(self):
+        return str(self.client_address) # Unix sockets have no host
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingMixIn(SocketServer.ThreadingMixIn):
+    """
+    Handles each connection in a daemon thread, and keeps track of the open
+    connections so server_close() can close them and wait for their threads
+    (keep-alive connections would otherwise keep them waiting for the next
+    request until the interpreter kills them at exit).
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {} # { handler thread: client socket }
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = self.daemon_threads
+        with self.lock:
+            self.connections[thread] = request
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address
+            )
+        finally:
+            with self.lock:
+                del self.connections[threading.current_thread()]
+
+    def server_close(self):
+        """
+        Stops listening, then closes every open connection and waits for its
+        thread to finish. Call shutdown() first.
+        """
+
+        SocketServer.TCPServer.server_close(self)
+        with self.lock:
+            connections = self.connections.items()
+        for thread, request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR) # The handler reads EOF
+            except socket.error:
+                pass # Already closed by the client
+            thread.join()
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    def __init__(self, *args):
+        ThreadingMixIn.__init__(self)
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+
+class ThreadedUnixHTTPServer(ThreadingMixIn, SocketServer.UnixStreamServer):
+    def __init__(self, *args):
+        ThreadingMixIn.__init__(self)
+        SocketServer.UnixStreamServer.__init__(self, *args)
+
+def serve(oracle, address='http://127.0.0.1:0'):
+    """
+    Starts serving @oracle in a daemon thread.
+
+    @param oracle [OracleServer]: Oracles to serve
+    @param address [str]: 'http://[host]:[port]' (port 0 picks a free port)
+                          or 'unix://[path]'
+    @returns [tuple]: ([SocketServer], [str]), where t[0] is the running
+                      server (call shutdown() and then server_close() to
+                      stop it) and t[1] is the address clients can connect
+                      to.
+    """
+
+    if address.startswith('unix://'):
+        path = address[len('unix://'):]
+        if os.path.exists(path):
+            os.remove(path)
+        httpd = ThreadedUnixHTTPServer(path, OracleHandler)
+    else:
+        host, port = address[len('http://'):].rsplit(':', 1)
+        httpd = ThreadedHTTPServer((host, int(port)), OracleHandler)
+        address = 'http://%s:%d' % httpd.server_address
+    httpd.oracle = oracle
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (httpd, address)
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    An HTTPConnection over a Unix socket.
+    """
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.__path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.__path)
+
+def connection(address):
+    """
+    @param address [str]: Server address (see serve())
+    @returns [httplib.HTTPConnection]: A new connection to the server
+    """
+
+    if address.startswith('unix://'):
+        return UnixHTTPConnection(address[len('unix://'):])
+    host, port = address[len('http://'):].rsplit(':', 1)
+    return httplib.HTTPConnection(host, int(port))
+
+class RemoteOracle:
+    """
+    Client for one session of an oracle hosted by an OracleServer. It has the
+    same public methods and attributes as the oracle itself, so it can be
+    passed to any attack in place of an in-process oracle. Errors raised by
+    the oracle are raised again as Exceptions with the same message.
+
+    Each thread gets its own keep-alive connection, so one RemoteOracle can be
+    shared by a pool of worker threads. close() closes all of them.
+    """
+
+    def __init__(self, address, name, session=None):
+        """
+        @param address [str]: Server address (see serve())
+        @param name [str]: Oracle name (a key of ORACLES)
+        @param session [str]: Session ID (a new session if not given)
+        """
+
+        self.__address = address
+        self.__path = '/%s/%s' % (name, session or uuid.uuid4().hex)
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__conns = [] # Every thread's connection, for close()
+        interface = self.__request('GET', self.__path)
+        self.__methods = set(interface['methods'])
+        self.__attributes = dict(decode(interface['attributes']))
+
+    def __request(self, verb, path, body=None):
+        """
+        Sends a request on this thread's connection, reconnecting once if the
+        server closed it.
+        """
+
+        for attempt in range(2):
+            if not hasattr(self.__local, 'conn'):
+                self.__local.conn = connection(self.__address)
+                with self.__lock:
+                    self.__conns.append(self.__local.conn)
+            try:
+                self.__local.conn.request(
+                    verb, path, json.dumps(body) if body is not None else None,
+                    {'Content-Type': 'application/json'}
+                )
+                response = self.__local.conn.getresponse()
+                result = json.loads(response.read())
+                break
+            except (httplib.HTTPException, socket.error):
+                self.__local.conn.close()
+                with self.__lock:
+                    self.__conns.remove(self.__local.conn)
+                del self.__local.conn
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise Exception(decode(result['error']))
+        return result
+
+    def close(self):
+        """
+        Closes the connections of every thread that used this oracle. Call it
+        once the oracle is no longer needed.
+        """
+
+        with self.__lock:
+            conns, self.__conns = self.__conns, []
+        for conn in conns:
+            conn.close()
+
+    def __getattr__(self, name):
+        if name in self.__attributes:
+            return self.__attributes[name]
+        if name not in self.__methods:
+            raise AttributeError(name)
+
+        def method(*args):
+            result = self.__request('POST', '%s/%s' % (self.__path, name),
+                                    {'args': encode(args)})
+            if 'error' in result:
+                raise Exception(decode(result['error']))
+            return decode(result['result'])
+
+        return method
+
+    def batch(self, method, calls):
+        """
+        Makes many calls to one method in a single request.
+
+        @param method [str]: Method name
+        @param calls [list]: Arguments (a tuple) for each call
+        @returns [list]: The result of each call, or an Exception for each
+                         call that raised one
+        """
+
+        response = self.__request('POST', '%s/batch' % self.__path, {
+            'method': method,
+            'calls': [encode(tuple(args)) for args in calls]
+        })
+        return [decode(result['result']) if 'result' in result
+                else Exception(decode(result['error']))
+                for result in response['results']]
+
+def batch(oracle, method, calls):
+    """
+    Makes many calls to one method of an oracle, in one request if it's a
+    RemoteOracle and one at a time otherwise.
+
+    @param oracle [object]: Oracle (in-process or a RemoteOracle)
+    @param method [str]: Method name
+    @param calls [list]: Arguments (a tuple) for each call
+    @returns [list]: The result of each call, or an Exception for each call
+                     that raised one
+    """
+
+    if isinstance(oracle, RemoteOracle):
+        return oracle.batch(method, calls)
+    results = []
+    for args in calls:
+        try:
+            results.append(getattr(oracle, method)(*args))
+        except Exception, e:
+            results.append(e)
+    return results
+
+def close_oracle(oracle):
+    """
+    Closes the connections of a RemoteOracle (in-process oracles have none).
+
+    @param oracle [object]: Oracle (in-process or a RemoteOracle)
+    """
+
+    if isinstance(oracle, RemoteOracle):
+        oracle.close()
+
+def open_oracle(address, name, session=None):
+    """
+    @param address [str]: Server address (see serve()), or None for an
+                          in-process oracle
+    @param name [str]: Oracle name (a key of ORACLES)
+    @param session [str]: Session ID for a remote oracle (a new session if
+                          not given)
+    @returns [object]: A new in-process oracle or a RemoteOracle
+    """
+
+    if address is None:
+        return oracle_class(name)()
+    return RemoteOracle(address, name, session)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Serve challenge oracles.')
+    parser.add_argument('address', nargs='?', default=None,
+                        help='http://host:port or unix://path (by default, '
+                             'run a demo against a local server)')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum calls per second to each session')
+    args = parser.parse_args()
+    oracle = OracleServer(args.latency, args.jitter, args.rate)
+
+    if args.address:
+        httpd, address = serve(oracle, args.address)
+        print 'Serving %s on %s' % (', '.join(sorted(ORACLES)), address)
+        try:
+            while True:
+                time.sleep(3600)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    # The same attacks, against in-process and remote oracles
+    from challenge12 import decrypt_session_secret
+    from challenge17 import decrypt
+    from challenge27 import recover_keys, check_keys
+    sockdir = tempfile.mkdtemp()
+    servers = []
+    try:
+        for address in ('unix://%s/oracle.sock' % sockdir,
+                        'http://127.0.0.1:0'):
+            servers.append(serve(oracle, address))
+        for address in [None] + [address for _, address in servers]:
+            start = time.time()
+            session = open_oracle(address, 'challenge12')
+            server = open_oracle(address, 'challenge17')
+            oracles = [open_oracle(address, 'challenge27') for _ in range(50)]
+            try:
+                msg, queries = decrypt_session_secret(session)
+                pt, _ = decrypt(server, *server.choose_random_string())
+                valid = check_keys(oracles, recover_keys(oracles))
+            finally:
+                map(close_oracle, [session, server] + oracles)
+            print '%-36s %6.2fs %r %r %d/%d keys' % (
+                address or 'in-process', time.time() - start, msg[:12],
+                pt[6:18], valid.sum(), len(oracles)
+            )
+
+        # Batch calls pay the latency once
+        oracle.latency = 0.005
+        remote = open_oracle(address, 'challenge16')
+        payloads = ['userdata%d' % i for i in range(100)]
+        try:
+            for name, call in (
+                ('one by one', lambda: map(remote.encrypt, payloads)),
+                ('batch', lambda: batch(remote, 'encrypt',
+                                        [(p,) for p in payloads]))
+            ):
+                start = time.time()
+                call()
+                print '%d calls %s: %.2fs' % (len(payloads), name,
+                                              time.time() - start)
+        finally:
+            close_oracle(remote)
+    finally:
+        for httpd, _ in servers:
+            httpd.shutdown()
+            httpd.server_close()
+        shutil.rmtree(sockdir)
@@ -15,38 +15,24 @@ frequency is a good metric. Evaluate each output and choose the one with the
 best score.
 """
 
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'misc'))
+from byteclass import CLASS_SCORES, count_classes
+
 def score(s):
     """
-    Returns the likelihood that a string is a valid PT string.
+    Returns the likelihood that a string is a valid PT string: the total
+    CLASS_SCORES of its bytes, counted a class at a time (see
+    misc/byteclass.py).
 
     @param s [str]: CT string.
     @return [int]: Number (-inf, +inf), where more positive means greater
                    likelihood that the CT is a string.
     """
-    def charscore(c):
-        """
-        Naively returns the score of a character (representing the likelihood
-        that the character implies a valid PT string).
-        """
-        # +1 if string is in the set of characters or spaces
-        positive_set = set(range(ord('a'), ord('a')+26) + [ord(' ')])
-        # -1 if the string is in the set of rarely used characters:
-        #   128, 153, 161-255
-        negative_set = set([128] + [153] + range(161, 255))
-        # -99 if the string is in the set of unused characters:
-        #   0-8, 11-31, 127, 129-152, 154-160
-        unused_set = set(range(0, 9) + range(11, 32) + [127] + range(129, 153)
-                         + range(154, 161))
-        if ord(c) in positive_set:
-            return 1
-        elif ord(c) in negative_set:
-            return -9
-        elif ord(c) in unused_set:
-            return -99
-        else:
-            return 0
 
-    return sum(map(charscore, [_ for _ in s]))
+    return int(count_classes(s).dot(CLASS_SCORES))
 
 def decrypt(s):
     """
@@ -60,22 +60,91 @@ def encryption_oracle(pt):
         # print False # Uncomment to check the oracle detector
         return aes_cbc_encrypt(key, padded_pt, iv)
 
+class CipherProfile:
+    """
+    What probe_cipher() learned about an encryption oracle:
+        blocksize: Blocksize of the cipher (1 for CTR and other stream ciphers)
+        mode: 'ECB', 'CBC' or 'CTR' (CTR stands for any stream cipher)
+        datalen: Number of bytes the oracle adds to every PT (e.g. the length
+                 of a prefix plus a secret suffix), or None if unknown
+        cts: Mapping of { payload: CT } for every payload the probe sent
+        queries: Number of oracle queries the probe made
+    """
+
+    def __init__(self):
+        self.blocksize = None
+        self.mode = None
+        self.datalen = None
+        self.cts = {}
+        self.queries = 0
+
+def probe_cipher(oracle, blocksize=None, maxlen=1024):
+    """
+    Profiles an encryption oracle with a handful of queries:
+        1. Keep adding one byte to the PT until the length of the CT changes.
+           For a block cipher, the CT grows by a whole block the first time
+           the PT plus the oracle's own data fills the last block (there's
+           always at least one byte of PKCS#7 padding), so the change is the
+           blocksize and the number of bytes it took gives the length of the
+           oracle's data. For a stream cipher, the CT grows by one byte
+           straight away.
+        2. For a block cipher, send three blocks of repeated bytes. However
+           the oracle offsets them, at least two consecutive PT blocks are
+           identical, which produces identical CT blocks in ECB mode (and, with
+           overwhelming probability, doesn't in CBC mode).
+    This is at most blocksize + 2 queries, or a single query if @blocksize is
+    given (in which case step 1 is skipped and datalen stays unknown).
+
+    @param oracle [object]: Oracle with an encrypt(pt) method, or the encrypt
+                            function itself
+    @param blocksize [int]: Blocksize, if already known
+    @param maxlen [int]: Maximum PT length to try before giving up
+    @returns [CipherProfile]: Profile of the oracle
+    """
+
+    def query(payload):
+        if payload not in profile.cts:
+            profile.queries += 1
+            profile.cts[payload] = encrypt(payload)
+        return profile.cts[payload]
+
+    encrypt = getattr(oracle, 'encrypt', oracle)
+    profile = CipherProfile()
+
+    if blocksize is None:
+        paddedlen = len(query(''))
+        padbytes = 1
+        while len(query('A' * padbytes)) == paddedlen:
+            if padbytes > maxlen:
+                raise Exception('CT length never changed.')
+            padbytes += 1
+        blocksize = len(query('A' * padbytes)) - paddedlen
+        profile.datalen = paddedlen - (padbytes if blocksize > 1 else 0)
+    profile.blocksize = blocksize
+
+    if blocksize == 1:
+        profile.mode = 'CTR'
+    else:
+        ct = query('A' * blocksize * 3)
+        blocks = [ct[i:i+blocksize] for i in range(0, len(ct), blocksize)]
+        repeated = any(blocks[i] == blocks[i+1] for i in range(len(blocks)-1))
+        profile.mode = 'ECB' if repeated else 'CBC'
+    return profile
+
 def detect_encryption_oracle():
     """
     Calls an encryption oracle (some function that encrypts a plaintext) and
     returns True if the encryption mode was ECB and False if the encryption
     mode was CBC. This particular encryption oracle is described above. Since
-    the blocksize of the encryption oracle is 16 bytes, the strategy is to feed
-    it a 48-byte string with 16-byte repetitions
-    (s[0..15] == s[16..31] == s[32..47]). Though the oracle pads the beginning
-    and end of the string (the first block will be pseudorandom), it is
-    guaranteed that the second and the third block will equal in ECB mode (and
-    improbable that they will in CBC mode).
+    the oracle picks a new key, mode and padding on every call, we can only
+    query it once, so the blocksize of 16 bytes is given to probe_cipher(),
+    which feeds it a 48-byte string with 16-byte repetitions. Though the oracle
+    pads the beginning and end of the string (the first block will be
+    pseudorandom), it is guaranteed that the second and the third block will
+    equal in ECB mode (and improbable that they will in CBC mode).
     """
 
-    pt = 'YELLOW SUBMARINE' * 3
-    ct = encryption_oracle(pt)
-    return ct[16:32] == ct[32:48]
+    return probe_cipher(encryption_oracle, blocksize=16).mode == 'ECB'
 
 if __name__=='__main__':
     print detect_encryption_oracle()
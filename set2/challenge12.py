@@ -51,17 +51,14 @@ those ciphertexts, and now you can. If our experience is any guideline, this
 attack will get you code execution in security tests about once a year.
 """
 
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'misc'))
+from byteclass import is_plausible_batch
+from checkpoint import AttackState
 from challenge10 import b642hex, aes_ecb_encrypt
-from challenge11 import rand_bytes
-
-def is_ascii(char):
-    """
-    @param char [str]: ASCII character
-    @returns True if @char is a valid ASCII character and False otherwise
-    """
-    return ord(char) not in set([128] + [153] + range(161, 255) + range(0, 9) +
-                                range(11, 32) + [127] + range(129, 153) +
-                                range(154, 161))
+from challenge11 import rand_bytes, probe_cipher
 
 class SessionOracle:
     """
@@ -94,70 +91,92 @@ class SessionOracle:
         padded_pt = pt + b642hex(self.__SECRET_STRING).decode('hex')
         return aes_ecb_encrypt(self.__key, padded_pt)
 
-def decrypt_session_secret():
+def likely_bytes():
+    """
+    Returns all 256 single-byte characters ordered from most to least likely
+    to appear in an English PT: spaces and lowercase letters by frequency, then
+    uppercase letters, common punctuation and digits, then every other
+    plausible byte (see misc/byteclass.py) and finally the implausible ones,
+    each in numeric order. Since decrypt_session_secret() stops at the first
+    match, an implausible byte is only ever queried once every plausible one
+    has been ruled out.
+
+    @returns [list]: List of 256 ASCII characters
+    """
+
+    common = (' etaoinshrdlcumwfgypbvkjxqz'
+              'ETAOINSHRDLCUMWFGYPBVKJXQZ'
+              '\n.,\'-?!"0123456789:;/()')
+    rest = [chr(i) for i in range(256) if chr(i) not in common]
+    plausible = is_plausible_batch(rest)
+    return (list(common) + [c for c, ok in zip(rest, plausible) if ok]
+            + [c for c, ok in zip(rest, plausible) if not ok])
+
+def decrypt_session_secret(oracle=None, resume_from=None, interval=1000):
     """
     Decrypt an AES 128 ECB mode oracle with a session key and PKCS#7 padding
     with the following steps:
-        1. Find out the blocksize and make sure the oracle is in ECB mode.
-           (see get_blocksize())
-        2. Get the unpadded length of the session message.
-           (see get_msg_length())
-        3. Decode the session message by checking payload messages of the form
+        1. Find out the blocksize, make sure the oracle is in ECB mode and get
+           the unpadded length of the session message.
+           (see challenge11.probe_cipher())
+        2. Decode the session message by checking payload messages of the form
            P || M || Y where P is a prefix of the desired length, M is the
            first |M| known bytes of the message, and Y is the character we
            think might be the next character of the message. We check this
            against the results of sending the payload P at the index of Y. If
-           the bytes match, we might have found a hit. Since multiple bytes can
-           match here, we use a recursive strategy to find the entire string.
+           the bytes match, we've found the next character.
            (see decode())
+    Querying the oracle is the expensive step, so the CT for each of the
+    blocksize distinct payloads P is only requested once (see target_ct()) and
+    candidate characters Y are tried in likelihood order (see likely_bytes()),
+    stopping at the first match.
+
+    Progress is kept in an AttackState, saved to @resume_from every @interval
+    queries. If @resume_from already holds a checkpoint from an attack on the
+    same oracle session, decoding picks up after the last byte it recovered.
+    The oracle is probed again on every run (~20 queries), which also checks
+    that the checkpoint is for this session.
+
+    @param oracle [SessionOracle]: Oracle to attack (a new SessionOracle if
+                                   not given)
+    @param resume_from [str]: Checkpoint file path
+    @param interval [int]: Number of queries between checkpoints
+    @returns [tuple]: ([str], [int]), where t[0] is the decoded secret message
+                      and t[1] is the total number of oracle queries made
+                      (including any made before resuming).
     """
 
-    def get_blocksize(maxlen=1024):
+    def encrypt(pt):
         """
-        Returns the blocksize of the oracle. Continually add one byte of
-        padding until, for an input message of length M, the first M/2 bytes of
-        the output message are equal to the second M/2 bytes. This also checks
-        that the oracle is using ECB mode. If no repetition is found up to a
-        large maximum length, then assume that ECB mode is not being used.
-
-        @returns [int]: Blocksize of the ECB mode cipher or False if no
-                        blocksize is found (this implies that ECB mode is not
-                        set).
+        Calls the oracle and counts the query.
         """
 
-        paddedlen = len(oracle.encrypt(''))
-        padbytes = 1
-        while (oracle.encrypt('A' * padbytes)[:padbytes/2]
-               != oracle.encrypt('A' * padbytes)[padbytes/2:padbytes]):
-            if padbytes > maxlen:
-                return False
-            padbytes += 1
-        return padbytes / 2
+        ct = oracle.encrypt(pt)
+        state.query()
+        return ct
 
-    def get_msg_length():
+    def target_ct(padlen):
         """
-        Returns the non-padded length of the secret message. The way to do this
-        is to find the length of the padded message and subtract the number of
-        bytes of padding. The number of bytes of padding can be found by
-        continually adding one byte of padding until the length of the returned
-        message changes (it will increase by blocksize).
+        Returns the CT of the payload 'A'*@padlen. There are only blocksize
+        distinct pad lengths, so each of these CTs is requested from the oracle
+        once (if the probe didn't already request it) and reused for every byte
+        that needs it.
 
-        @returns [int]: Non-padded length of the secret message.
+        @param padlen [int]: Length of the payload.
+        @returns [str]: ASCII CT
         """
 
-        paddedlen = len(oracle.encrypt(''))
-        for i in range(1, blocksize+1): # 1 pad is required where msglen %
-                                        # blocksize is 0
-                                        # blocksize pads are required where
-                                        # msglen % blocksize is 1
-            if paddedlen != len(oracle.encrypt('A' * i)):
-                return paddedlen - i + 1
+        payload = 'A' * padlen
+        if payload not in targets:
+            targets[payload] = encrypt(payload)
+        return targets[payload]
 
     def next_byte(padlen, blockidx, msg):
         """
         Sends the following payloads to the oracle:
-            'A'*@padlen || @msg || Y, where Y is a char from 0x00 to 0xff
-            'A'*@padlen, the target payload
+            'A'*@padlen, the target payload (cached, see target_ct())
+            'A'*@padlen || @msg || Y, where Y is each character returned by
+            likely_bytes() in turn
         Assuming @msg is correct (is equal to the first |@msg| bytes of the
         secret message), the first |'A'*@padlen| + |@msg| bytes of all payloads
         (including the target payload) should be the same, and the next byte
@@ -166,9 +185,9 @@ def decrypt_session_secret():
         blocks. The next character is the Y where the CT of the first
         |'A'*@padlen| + |@msg| + 1 bytes are equal to the same first bytes of
         CT from the target payload. Since each PT uniquely maps to a CT, there
-        can only be one correct Y. And there must be at least one correct Y
-        because the domain of Y spans the set of all possible characters.
-        Return Y.
+        can only be one correct Y, so we can stop at the first match. And there
+        must be at least one correct Y because the candidates span the set of
+        all possible characters. Return Y.
 
         @param padlen [int]: Length of the payload.
         @param blockidx [int]: The block the target byte is in.
@@ -178,41 +197,47 @@ def decrypt_session_secret():
 
         payload_prefix = 'A' * padlen
         blockcmp = blocksize * (blockidx + 1)
-        # Mapping of { ptbyte: ct[:blockcmp] } for all pt bytes [int] in
-        # (0, 255).
-        ct_mapping = [oracle.encrypt(payload_prefix + msg + chr(c))[:blockcmp]
-                      for c in range(256)]
-        target_str = oracle.encrypt(payload_prefix)[:blockcmp]
-        possibilities = [chr(i) for i, ctprefix in enumerate(ct_mapping)
-                         if ctprefix == target_str][0] # Should always be
-                                                       # of length 1
-        return possibilities
+        target_str = target_ct(padlen)[:blockcmp]
+        for c in candidates:
+            if encrypt(payload_prefix + msg + c)[:blockcmp] == target_str:
+                return c
 
     def decode():
         """
         Decodes the secret message by finding successive bytes of the message
-        blockwise. To find the first byte, the padding starts at blocksize - 1
-        and decreases until the first entire block is found. Then the process
-        repeats for successive blocks until the entire message is found.
+        blockwise, starting after the bytes already in the attack state. To
+        find the first byte of a block, the padding is blocksize - 1 and it
+        decreases until the entire block is found. Then the process repeats
+        for successive blocks until the entire message is found.
 
         @returns [str]: The decoded oracle secret message.
         """
 
-        msg = ''
-        padlen = blocksize - 1
-        blockidx = 0
+        msg = state.recovered
         while len(msg) < msglen:
-            if padlen == 0:
-                padlen = blocksize
-                blockidx += 1
-            msg += next_byte(padlen, blockidx, msg)
-            padlen -= 1
+            blockidx, byteidx = divmod(len(msg), blocksize)
+            msg += next_byte(blocksize - byteidx - 1, blockidx, msg)
+            state.recovered = msg
+            state.blockidx, state.byteidx = divmod(len(msg), blocksize)
         return msg
 
-    oracle = SessionOracle()
-    blocksize = get_blocksize()
-    msglen = get_msg_length()
-    return decode()
+    oracle = oracle or SessionOracle()
+    state = AttackState.load(resume_from, interval)
+    profile = probe_cipher(encrypt)
+    if profile.mode != 'ECB':
+        raise Exception('Oracle is not using ECB mode.')
+    state.resume(profile.cts[''].encode('hex'))
+    blocksize = profile.blocksize
+    msglen = profile.datalen
+    targets = dict(profile.cts) # Mapping of { P: E_k(P || SECRET_STRING) }
+    candidates = likely_bytes()
+    msg = decode()
+    if resume_from:
+        state.save()
+    return (msg, state.queries)
 
 if __name__=='__main__':
-    print decrypt_session_secret()
+    msg, queries = decrypt_session_secret()
+    print msg
+    print 'Oracle queries: %d (%.2f per byte)' % (queries,
+                                                 float(queries) / len(msg))
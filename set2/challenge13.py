@@ -47,8 +47,9 @@ Using only the user input to profile_for() (as an oracle to generate "valid"
 ciphertexts) and the ciphertexts themselves, make a role=admin profile.
 """
 
+from challenge9 import pkcs7_pad
 from challenge10 import aes_ecb_encrypt, aes_ecb_decrypt
-from challenge11 import rand_bytes
+from challenge11 import rand_bytes, probe_cipher
 
 class SessionOracle:
     """
@@ -65,65 +66,195 @@ class SessionOracle:
     def decrypt(self, ct):
         return aes_ecb_decrypt(self.__key, ct)
 
+    def encrypt_profile(self, email):
+        """
+        The attacker's view of the oracle: encrypts the encoded profile for
+        @email.
+
+        @param email [str]: Email address
+        @returns [str]: ASCII CT of profile_for(@email)
+        """
+
+        return self.encrypt(profile_for(email))
+
+    def decrypt_profile(self, ct):
+        """
+        Decrypts an encrypted profile, strips its PKCS#7 padding and parses it.
+
+        @param ct [str]: ASCII CT
+        @returns [dict]: The profile (see paramstr_to_obj())
+        """
+
+        pt = self.decrypt(ct)
+        return paramstr_to_obj(pt[:-ord(pt[-1])])
+
 def paramstr_to_obj(paramstr):
-    obj = {}
-    for param in paramstr.split('&'):
-        k, v = param.split('=')
-        obj[k] = v
-    return obj
-
-def profile_for(email):
-    obj = {
-        'email': email,
-        'uid': 10,
-        'role': 'user'
-    }
-    return '&'.join(['%s=%s' % (k, v) for k, v in obj.iteritems()])
-
-def make_user_admin(email):
     """
-    Construct the modified encrypted CT corresponding to the url encoded
-    paramstr email=[email]&uid=10&role=admin using only calls to the oracle
-    (calls to aes_ecb_encrypt with the same session key).
+    Parses a k=v string such as foo=bar&baz=qux. Values may contain '='
+    (only the first one in each parameter separates the key).
 
-    @param email [str]: The email used to generate the url encoded string
-                  email=[email]&uid=10&role=user
-    @returns [str]: An encrypted CT that when decrypted returns the url encoded
-                    string email=[email]&uid=10&role=admin
+    @param paramstr [str]: Encoded parameters
+    @returns [dict]: Mapping of { key: value }
     """
 
-    def get_blocksize(maxlen=1024):
+    return dict([param.split('=', 1) for param in paramstr.split('&')])
+
+def profile_for(email, uid=10, role='user'):
+    """
+    Encodes the profile for @email as email=[email]&uid=[uid]&role=[role],
+    always in that order. The metacharacters & and = are eaten from @email.
+
+    @param email [str]: Email address
+    @param uid [int]: User ID
+    @param role [str]: User role
+    @returns [str]: Encoded profile
+    """
+
+    return 'email=%s&uid=%d&role=%s' % (email.translate(None, '&='), uid,
+                                         role)
+
+class ProfileLayout:
+    """
+    Layout of an encoded profile around the email, which is the only part the
+    attacker controls. It's modelled by encoding a marker email:
+        prefix: Bytes before the email ('email=')
+        suffix: Bytes between the email and the role ('&uid=10&role=')
+        role: Role given to new profiles ('user')
+    """
+
+    MARKER = '\x00'
+
+    def __init__(self, encode=profile_for):
+        """
+        @param encode [function]: Profile encoder
+        """
+
+        self.prefix, rest = encode(self.MARKER).split(self.MARKER)
+        rest, self.role = rest.rsplit('=', 1)
+        self.suffix = rest + '='
+
+    def fill(self, blocksize):
         """
-        Returns the blocksize of the oracle. Continually add one byte of
-        padding until, for an input message of length M, the first M/2 bytes of
-        the output message are equal to the second M/2 bytes. This also checks
-        that the oracle is using ECB mode. If no repetition is found up to a
-        large maximum length, then assume that ECB mode is not being used.
-
-        @returns [int]: Blocksize of the ECB mode cipher or False if no
-                        blocksize is found (this implies that ECB mode is not
-                        set).
+        @param blocksize [int]: Blocksize of the cipher
+        @returns [int]: Number of email bytes needed to finish the block the
+                        prefix is in, so that the next email byte starts a
+                        block
         """
 
-        paddedlen = len(oracle.encrypt(''))
-        padbytes = 1
-        while (oracle.encrypt('A' * padbytes)[:padbytes/2]
-               != oracle.encrypt('A' * padbytes)[padbytes/2:padbytes]):
-            if padbytes > maxlen:
-                return False
-            padbytes += 1
-        return padbytes / 2
+        return -len(self.prefix) % blocksize
 
+    def aligned_length(self, length, blocksize):
+        """
+        @param length [int]: Minimum email length
+        @param blocksize [int]: Blocksize of the cipher
+        @returns [int]: The smallest email length >= @length that ends
+                        prefix || email || suffix on a block boundary, so that
+                        the role starts a block
+        """
+
+        return length + (-(len(self.prefix) + length + len(self.suffix))
+                         % blocksize)
+
+def lengthen_email(email, length):
+    """
+    Lengthens @email to @length characters without changing where mail to it
+    is delivered, by adding (or extending) a +tag on the local part:
+    foo@bar.com becomes foo+xxx@bar.com.
+
+    @param email [str]: Email address
+    @param length [int]: Desired length (at least |@email|)
+    @returns [str]: Email address of length @length
+    """
+
+    extra = length - len(email)
+    if extra == 0:
+        return email
+    local, at, domain = email.partition('@')
+    tag = 'x' * extra if '+' in local else '+' + 'x' * (extra - 1)
+    return local + tag + at + domain
+
+def plan_cut_and_paste(email, blocksize, role='admin', layout=None):
+    """
+    Plans a cut-and-paste of encrypted profile blocks that decrypts to
+        prefix || E || suffix || @role || padding
+    where E is @email lengthened (see lengthen_email()) so that the role
+    starts a block. In ECB mode each CT block depends only on its own PT
+    block, so it's enough to get the blocks of
+        A = prefix || E || suffix and R = pkcs7_pad(@role)
+    encrypted at block boundaries, and both fit in one query: with f bytes
+    needed to fill the prefix's block (see ProfileLayout.fill()), the profile
+    for E[:f] || R || E[f:] encodes as
+        prefix || E[:f] | R | E[f:] || suffix | user || padding
+    (| marking block boundaries), and cutting out the R blocks and pasting
+    them over the 'user' block gives the admin profile. R can't contain & or
+    =, which the encoder eats, and nothing in it can since the pad bytes are
+    less than the blocksize.
+
+    @param email [str]: Email address for the admin profile
+    @param blocksize [int]: Blocksize of the cipher
+    @param role [str]: Role to give the profile
+    @param layout [ProfileLayout]: Layout of the encoded profile
+    @returns [tuple]: ([str], [list], [str]), where t[0] is the email to
+                      query, t[1] is the indices of the blocks of its CT to
+                      splice together, in order, and t[2] is the email of the
+                      resulting profile.
+    """
+
+    layout = layout or ProfileLayout()
+    if '&' in role or '=' in role:
+        raise Exception('Role %r contains a metacharacter.' % role)
+    email = email.translate(None, '&=')
+    fill = layout.fill(blocksize)
+    email = lengthen_email(email, layout.aligned_length(max(len(email), fill),
+                                                        blocksize))
+    role_block = pkcs7_pad(role, blocksize)
+    query = email[:fill] + role_block + email[fill:]
+
+    role_start = (len(layout.prefix) + fill) / blocksize
+    role_end = role_start + len(role_block) / blocksize
+    aligned_end = (len(layout.prefix) + len(query) + len(layout.suffix)
+                   ) / blocksize
+    blocks = (range(role_start) + range(role_end, aligned_end)
+              + range(role_start, role_end))
+    return (query, blocks, email)
+
+def make_user_admin(email, oracle=None):
+    """
+    Construct the modified encrypted CT corresponding to the url encoded
+    paramstr email=[email]&uid=10&role=admin using only calls to the profile
+    oracle (SessionOracle.encrypt_profile()). After probing the oracle for
+    its blocksize and mode (see challenge11.probe_cipher()), a single query
+    planned by plan_cut_and_paste() is enough.
+
+    @param email [str]: The email used to generate the url encoded string
+                  email=[email]&uid=10&role=user
+    @param oracle [SessionOracle]: Oracle to attack (a new SessionOracle if
+                                   not given)
+    @returns [tuple]: ([str], [int]), where t[0] is an encrypted CT that when
+                      decrypted returns the url encoded string
+                      email=[email]&uid=10&role=admin (with @email lengthened
+                      by a +tag if needed) and t[1] is the number of oracle
+                      queries made.
+    """
+
+    oracle = oracle or SessionOracle()
+    cipher = probe_cipher(oracle.encrypt_profile)
+    if cipher.mode != 'ECB':
+        raise Exception('Oracle is not using ECB mode.')
+    blocksize = cipher.blocksize
+    query, blocks, _ = plan_cut_and_paste(email, blocksize)
+    ct = oracle.encrypt_profile(query)
+    ct_blocks = [ct[i:i+blocksize] for i in range(0, len(ct), blocksize)]
+    return (''.join(ct_blocks[i] for i in blocks), cipher.queries + 1)
+
+if __name__=='__main__':
     oracle = SessionOracle()
     # Make sure it's working
-    encrypted_profile = oracle.encrypt(profile_for(email))
-    decrypted_profile = oracle.decrypt(encrypted_profile)
+    encrypted_profile = oracle.encrypt_profile('foo@bar.com')
     print encrypted_profile.encode('hex')
-    print decrypted_profile
-
-    # Now, only using @email and @encrypted_profile, make a role=admin profile.
-    blocksize = get_blocksize()
-    return
+    print oracle.decrypt_profile(encrypted_profile)
 
-if __name__=='__main__':
-    make_user_admin('foo@bar.com')
+    ct, queries = make_user_admin('foo@bar.com', oracle)
+    print ct.encode('hex')
+    print oracle.decrypt_profile(ct)
+    print 'Oracle queries: %d' % queries
@@ -17,7 +17,8 @@ Think "STIMULUS" and "RESPONSE".
 """
 
 from challenge10 import b642hex, aes_ecb_encrypt
-from challenge11 import rand_bytes, rand_bytes_range
+from challenge11 import rand_bytes, rand_bytes_range, probe_cipher
+from challenge12 import likely_bytes
 
 class SessionOracle:
     """
@@ -53,103 +54,119 @@ class SessionOracle:
                      + b642hex(self.__SECRET_STRING).decode('hex'))
         return aes_ecb_encrypt(self.__key, padded_pt)
 
-def decrypt_session_secret():
+class AttackContext:
+    """
+    Everything the attack has learned about the oracle, shared by each stage
+    of the attack:
+        blocksize: Blocksize of the ECB mode cipher
+        prefixlen: Length of the oracle's random prefix
+        pad_prefixlen: Length of the extra padding that must be prepended to
+                       the input to block-align what follows it
+        msg_offset: Index of the first block following the prefix and the
+                    extra padding
+        msglen: Length of the secret message
+        queries: Total number of oracle queries made
+        cts: Mapping of { payload: CT } of the fill payloads, which are reused
+             by every stage of the attack
+    """
 
-    def get_blocksize():
-        """
-        Returns the blocksize of the oracle. Continually add one byte of
-        padding until the size of the returned CT changes. The difference in
-        the CT lengths is the blocksize.
+    def __init__(self, oracle):
+        self.oracle = oracle
+        self.blocksize = None
+        self.prefixlen = None
+        self.pad_prefixlen = None
+        self.msg_offset = None
+        self.msglen = None
+        self.queries = 0
+        self.cts = {}
 
-        @returns [int]: Blocksize of the ECB mode cipher.
+    def encrypt(self, pt):
+        """
+        Calls the oracle and counts the query.
         """
 
-        paddedlen = len(oracle.encrypt(''))
-        padbytes = 0
-        while len(oracle.encrypt('A' * padbytes)) == paddedlen:
-            padbytes += 1
-        return len(oracle.encrypt('A' * padbytes)) - paddedlen
+        self.queries += 1
+        return self.oracle.encrypt(pt)
 
-    def get_msg_length():
+    def fill(self, n, char='A'):
         """
-        Returns the non-padded length of the secret message. The way to do this
-        is to find the length of the padded message and subtract the number of
-        bytes of padding. The number of bytes of padding can be found by
-        continually adding one byte of padding until the length of the returned
-        message changes (it will increase by blocksize).
+        Returns the CT of the payload @char*@n. Each one is only requested from
+        the oracle once.
 
-        @returns [int]: Non-padded length of the secret message.
+        @param n [int]: Length of the payload
+        @param char [str]: Fill character
+        @returns [str]: ASCII CT
         """
 
-        paddedlen = len(oracle.encrypt(''))
-        for i in range(1, blocksize+1): # 1 pad is required where msglen %
-                                        # blocksize is 0
-                                        # blocksize pads are required where
-                                        # msglen % blocksize is 1
-            if paddedlen != len(oracle.encrypt('A' * i)):
-                return paddedlen - i + 1
+        payload = char * n
+        if payload not in self.cts:
+            self.cts[payload] = self.encrypt(payload)
+        return self.cts[payload]
 
-    def get_prefix_offset():
-        """
-        Finds the amount of padding the input PT must be offset by by
-        continually adding one byte of padding and calling the oracle until a
-        repetition is produced. Returns the number of padding bytes that must
-        be added and the starting index of the block-aligned message.
-
-        @returns [tuple]: ([int], [int]), where t[0] is the length of padding
-                          that must be prepended to block-align the message and
-                          t[1] is the index of the beginning of the message
-                          with that padding.
-        """
+def discover_alignment(ctx):
+    """
+    Finds the blocksize, the prefix length and the secret message length of
+    the oracle and stores them in @ctx. Suppose the oracle has the following
+    PT (blocksize of 8):
+        |R...R| ... |RRRMMMMM| ... |M...M|
+    1. Profile the oracle with challenge11.probe_cipher(), which keeps adding
+       one byte of padding until the size of the returned CT changes. The
+       difference in the CT lengths is the blocksize, and the number of
+       padding bytes it took, |P|, gives |R| + |M| = |CT| - |P| (there's
+       always at least one byte of PKCS#7 padding). It also checks that the
+       oracle is using ECB mode.
+    2. Encrypt a block of each of two distinct fill bytes, 'A' and 'B'. The
+       first CT block that differs is the block our input starts in, so the
+       prefix fills every block before it:
+        |R...R| ... |RRRAAAAA|AAA...   vs.   |R...R| ... |RRRBBBBB|BBB...
+    3. Find the number of 'A's it takes to fill the rest of that block by
+       sending 'A'*k || 'B'. That block matches the all-'A' CT from step 2 if
+       and only if the 'B' lands in the next block, so the smallest such k can
+       be binary searched:
+        |R...R| ... |RRRAAB..| (differs)   |R...R| ... |RRRAAAAA|B... (same)
+    This takes at most blocksize + 3 + log2(blocksize + 1) queries.
+
+    @param ctx [AttackContext]: Context of the attack
+    """
 
-        def block_repetition(s):
-            """
-            Returns True if there is a block reptition in a string:
-            |A...A|B...B|...|R...R|R...R|S...S|, the block |R...R| is repeated.
-
-            @returns [tuple]: ([bool], [int]), Returns (True, i) where i is the
-                              index of the first character of the block
-                              following the repetition if a repetition is
-                              found. Returns (False, -1) otherwise.
-            """
-
-            for i in range(0, len(s)-blocksize, blocksize):
-                if s[i:i+blocksize] == s[i+blocksize:i+2*blocksize]:
-                    return (True, i + 2*blocksize)
-            return (False, -1)
-
-        padlen = 0
-        repetition, index = block_repetition(oracle.encrypt('A' * padlen))
-        while not repetition:
-            padlen += 1
-            repetition, index = block_repetition(oracle.encrypt('A' * padlen))
-        return (padlen, index)
-
-    def get_msg_length():
-        """
-        This is slightly more complicated than the same function in challenge
-        12 but the idea is the same. Keep adding padding bytes until the CT
-        length changes. This is the length of padding added to the PT. Subtract
-        that from the length of the returned CT. In this case, we start with a
-        padded, block-aligned message:
-        |R...R| ... |RRRPPPPP|PPPPPPPP|PPPPPPPP|M...M|MMMppppp| where p are
-        padding bytes. We want to find the number of p. So, add Q:
-        |R...R| ... |RRRPPPPP|PPPPPPPP|PPPPPPPP|QQQQQQMM|M...M|MMMMMMMM|M
-        until the size of the CT changes. The number of p in the original
-        message is equal to the number of extra padding bytes |Q| - 1. The
-        length of the message is given by:
-        |msg| - (|R| + |P|) - (|Q| - 1)
-
-        @returns [int]: The length of the secret message.
-        """
+    profile = probe_cipher(ctx.encrypt)
+    if profile.mode != 'ECB':
+        raise Exception('Oracle is not using ECB mode.')
+    ctx.cts.update(profile.cts)
+    blocksize = profile.blocksize
+    totallen = profile.datalen # |R| + |M|
+
+    block = lambda s, i: s[i*blocksize:(i+1)*blocksize]
+    filled_a = ctx.fill(blocksize, 'A')
+    filled_b = ctx.fill(blocksize, 'B')
+    prefixblock = [i for i in range(len(filled_a) / blocksize)
+                   if block(filled_a, i) != block(filled_b, i)][0]
+
+    lo, hi = 0, blocksize # 'A'*blocksize always fills the block
+    while lo < hi:
+        mid = (lo + hi) / 2
+        if (block(ctx.encrypt('A' * mid + 'B'), prefixblock)
+            == block(filled_a, prefixblock)):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    ctx.blocksize = blocksize
+    ctx.pad_prefixlen = lo % blocksize
+    ctx.prefixlen = prefixblock * blocksize + (blocksize - lo) % blocksize
+    ctx.msg_offset = ctx.prefixlen + ctx.pad_prefixlen
+    ctx.msglen = totallen - ctx.prefixlen
+
+def decrypt_session_secret(oracle=None):
+    """
+    Decrypts the secret string of an AES 128 ECB mode oracle that prepends a
+    random prefix to every PT. See decode() for the strategy.
 
-        paddedlen = len(oracle.encrypt('A' * pad_prefixlen))
-        for i in range(1, blocksize+1): # 1 pad is required where msglen %
-                                        # blocksize is 0
-                                        # blocksize pads are required where
-                                        # msglen % blocksize is 1
-            if paddedlen != len(oracle.encrypt('A' * (pad_prefixlen + i))):
-                return paddedlen - msg_offset - (i - 1)
+    @param oracle [SessionOracle]: Oracle to attack (a new SessionOracle if
+                                   not given)
+    @returns [tuple]: ([str], [int]), where t[0] is the decoded secret message
+                      and t[1] is the total number of oracle queries made.
+    """
 
     def next_byte(padlen, blockidx, msg):
         """
@@ -167,52 +184,53 @@ def decrypt_session_secret():
                                This needs to be offset by the blocks taking up
                                by the prefix and extra padding.
         @param msg [str]: Current known message.
-        @returns [list]: List of possible ASCII characters that the next
-                         character in the message could be.
+        @returns [str]: Next character in the message.
         """
 
-        blockcmp = blocksize * (blockidx + 1)
-        target_msg = oracle.encrypt('A' * (pad_prefixlen + padlen))
-        ct_mapping = [oracle.encrypt('A' * (pad_prefixlen + padlen) + msg + c)
-                      for c in map(chr, range(0, 255))]
-        next_byte = [chr(i) for i, ct in enumerate(ct_mapping)
-                     if (ct[msg_offset:msg_offset+blockcmp]
-                         == target_msg[msg_offset:msg_offset+blockcmp])][0]
-        return next_byte
+        payload_prefix = 'A' * (ctx.pad_prefixlen + padlen)
+        cmpstart = ctx.msg_offset
+        cmpend = ctx.msg_offset + ctx.blocksize * (blockidx + 1)
+        target_str = ctx.fill(len(payload_prefix))[cmpstart:cmpend]
+        for c in candidates:
+            ct = ctx.encrypt(payload_prefix + msg + c)
+            if ct[cmpstart:cmpend] == target_str:
+                return c
 
     def decode():
         """
         Strategy:
             Suppose the oracle has the following message PT (blocksize of 8).
             R...R| ... |RRRMMMMM| ... | M...M
-            We want to continually add bytes of padding until this happens:
-            R...R| ... |RRRPPPPP|PPPPPPPP|PPPPPPPP|M...M
-            We detect when this happens as the smallest length of padding P
-            such that there is a repitition among blocks. Then, the problem
-            reduces the problem solved in challenge 12 with two caveats:
+            We want to add just enough bytes of padding that this happens:
+            R...R| ... |RRRPPPPP|M...M
+            The amount of padding is found by discover_alignment(). Then, the
+            problem reduces the problem solved in challenge 12 with two
+            caveats:
                 1. The current block index blockidx is offset by the index of
-                   the block immediately following the repeated blocks.
+                   the block immediately following the padding.
                 2. In all calls to the oracle, you must prepend an extra |P|
                    bytes to the PT, where |P| is the length of the smallest
-                   padding P required to cause a repetition.
+                   padding P required to block-align the message.
         """
 
         msg = ''
-        padlen = blocksize - 1
+        padlen = ctx.blocksize - 1
         blockidx = 0
-        while len(msg) < msglen:
+        while len(msg) < ctx.msglen:
             if padlen == 0:
-                padlen = blocksize
+                padlen = ctx.blocksize
                 blockidx += 1
             msg += next_byte(padlen, blockidx, msg)
             padlen -= 1
         return msg
 
-    oracle = SessionOracle()
-    blocksize = get_blocksize()
-    pad_prefixlen, msg_offset = get_prefix_offset()
-    msglen = get_msg_length()
-    return decode()
+    ctx = AttackContext(oracle or SessionOracle())
+    candidates = likely_bytes()
+    discover_alignment(ctx)
+    return (decode(), ctx.queries)
 
 if __name__=='__main__':
-    print decrypt_session_secret()
+    msg, queries = decrypt_session_secret()
+    print msg
+    print 'Oracle queries: %d (%.2f per byte)' % (queries,
+                                                 float(queries) / len(msg))
@@ -41,8 +41,9 @@ Before you implement this attack, answer this question: why does CBC mode have
 this property?
 """
 
-from challenge9 import pkcs7_pad
-from challenge10 import aes_cbc_encrypt, aes_cbc_decrypt, xorstr
+import timeit
+import numpy as np
+from challenge10 import aes_cbc_encrypt, aes_cbc_decrypt
 from challenge11 import rand_bytes
 
 class SessionOracle:
@@ -76,28 +77,102 @@ class SessionOracle:
                 if len(tup) == 2 and tup[0] == 'admin' and tup[1] == 'true']
         return len(vals) > 0
 
+def plan_injection(length, offset, blocksize=16):
+    """
+    Works out where the bytes of a @length-byte payload injected at PT offset
+    @offset go. Flipping bits of C_i-1 flips the same bits of P_i, but it
+    also scrambles P_i-1, so a block can't both receive payload bytes and be
+    sacrificed for the block after it. The payload therefore fills its first
+    block from @offset, and each further blocksize bytes go two blocks later,
+    with every other block (starting with the one before @offset) sacrificed:
+        | sacrificed | payload[:n] | sacrificed | payload[n:n+blocksize] | ...
+    where n = blocksize - @offset % blocksize.
+
+    @param length [int]: Payload length
+    @param offset [int]: PT offset of the first payload byte
+    @param blocksize [int]: Blocksize of the cipher
+    @returns [np.array]: PT offsets of the payload bytes, in payload order
+    """
+
+    if offset < blocksize:
+        raise Exception('The first block can only be changed through the IV.')
+    idx = np.arange(length) + offset % blocksize
+    return offset - offset % blocksize + idx + idx / blocksize * blocksize
+
+def flip_payloads(ct, original, payloads, offset, blocksize=16):
+    """
+    Modifies @ct once for each payload in @payloads, so that each modified CT
+    decrypts with the payload at PT offset @offset (see plan_injection() for
+    where the bytes of longer payloads go). For payload byte p landing on PT
+    byte P_i[j] with original value o, set C'_i-1[j] = C_i-1[j] XOR o XOR p.
+    Only the original PT bytes at the payload positions have to be known.
+
+    Shorter payloads are extended with the original bytes (a zero XOR delta),
+    so all the payloads share one layout and every modified CT is built in a
+    single vectorized XOR of the CT rows with the delta matrix.
+
+    @param ct [str]: ASCII CT
+    @param original [str]: Original PT bytes at the positions the longest
+                           payload is written to, in payload order
+    @param payloads [list]: Payloads to inject
+    @param offset [int]: PT offset of the first payload byte
+    @param blocksize [int]: Blocksize of the cipher
+    @returns [list]: Modified CTs, one for each payload
+    """
+
+    maxlen = max(len(payload) for payload in payloads)
+    positions = plan_injection(maxlen, offset, blocksize)
+    if positions[-1] >= len(ct):
+        raise Exception('Payload of %d bytes at offset %d runs past the CT.'
+                        % (maxlen, offset))
+    original = original[:maxlen]
+    orig = np.frombuffer(original, dtype=np.uint8)
+    pays = np.frombuffer(''.join(payload + original[len(payload):]
+                                 for payload in payloads),
+                         dtype=np.uint8).reshape(len(payloads), maxlen)
+    cts = np.tile(np.frombuffer(ct, dtype=np.uint8), (len(payloads), 1))
+    cts[:, positions - blocksize] ^= pays ^ orig
+    return [row.tostring() for row in cts]
+
+def inject_payloads(oracle, payloads, blocksize=16):
+    """
+    Gets one CT from the oracle for user data of 'A's and injects every
+    payload in @payloads into it (see flip_payloads()). The payloads start
+    at the second block boundary after the prefix, so the sacrificed blocks
+    are all user data and the prefix and suffix decrypt intact.
+
+    @param oracle [SessionOracle]: Oracle to attack
+    @param payloads [list]: Payloads to inject
+    @param blocksize [int]: Blocksize of the cipher
+    @returns [list]: Modified CTs, one for each payload
+    """
+
+    maxlen = max(len(payload) for payload in payloads)
+    offset = (len(oracle.PREFIX) + blocksize - 1) / blocksize * blocksize
+    offset += blocksize
+    positions = plan_injection(maxlen, offset, blocksize)
+    ct = oracle.encrypt('A' * (positions[-1] + 1 - len(oracle.PREFIX)))
+    return flip_payloads(ct, 'A' * maxlen, payloads, offset, blocksize)
+
 def create_admin(pt, ct):
     """
     Consider the CBC decryption algorithm:
         P_i = D_k(C_i) XOR C_i-1; C_0 = IV for all blocks i
     We wish to construct a modified CT C' that when decrypted gives us the
     desired string ';admin=true;'. So, if we were to find C' such that the ith
-    block would contain P_i' = ';admin=true;\x04\x04\x04\x04', we need to find
+    block would contain P_i' = ';admin=true;...', we need to find
     C'_i-1 = P_i' XOR D_k(C_i). Since P_i = D_k(C_i) XOR C_i-1 and we have
     both P and C (and hence P_i and C_i-1), we can rewrite
     D_k(C_i) = P_i XOR C_i-1. So, C'_i-1 = P_i' XOR P_i XOR C_i-1.
-    Assume we know the blocksize is 16 bytes.
+    Assume we know the blocksize is 16 bytes. The payload goes at the start
+    of the 4th block, scrambling the 3rd (see flip_payloads()).
     """
 
     blocksize = 16
-    idx = 2 # Rewrite the second block of the CT to produce a PT with a
-            # scrambled second block and our target 3rd block. idx is i-1
-    block_text = pkcs7_pad(';admin=true;', blocksize)
-    ct_blocks = [ct[i:i+blocksize] for i in range(0, len(ct), blocksize)]
-    pt_blocks = [pt[i:i+blocksize] for i in range(0, len(pt), blocksize)]
-    ct_new_block = xorstr(xorstr(block_text, pt_blocks[idx+1]), ct_blocks[idx])
-    ct_blocks[idx] = ct_new_block
-    return ''.join(ct_blocks)
+    offset = 3 * blocksize
+    payload = ';admin=true;'
+    return flip_payloads(ct, pt[offset:offset+len(payload)], [payload],
+                         offset, blocksize)[0]
 
 if __name__ == '__main__':
     oracle = SessionOracle()
@@ -114,3 +189,17 @@ if __name__ == '__main__':
     )
     # See the decrypted PT of the CT string we created
     print oracle.decrypt(create_admin(oracle.PREFIX + pt + oracle.SUFFIX, ct))
+
+    # Fuzz the parser with a batch of payloads, including ones spanning
+    # several blocks (with a scrambled block between each block of payload,
+    # which breaks up parameters that straddle the boundary)
+    payloads = [';admin=true;', ';admin=true', 'admin=true;', ';admin=false;',
+                ';Admin=true;', ';admin=true;;', ';admin==true;',
+                ';comment3=xxxxxx;admin=true;', ';comment3=xxxxx;admin=true;',
+                ';' * 40]
+    for payload, modified in zip(payloads, inject_payloads(oracle, payloads)):
+        print '%-5s %r' % (oracle.admin_exists(modified), payload)
+    payloads = [';admin=%06d;' % i for i in range(100000)]
+    duration = timeit.timeit(lambda: inject_payloads(oracle, payloads),
+                             number=1)
+    print 'Injected %d payloads in %.3fs' % (len(payloads), duration)
@@ -60,10 +60,21 @@ It's an attack that targets a specific bit of code that handles decryption.
 You can mount a padding oracle on any CBC block, whether it's padded or not.
 """
 
+import Queue
 import binascii
+import os
 import random
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'misc'))
+from byteclass import is_plausible_batch
+from checkpoint import AttackState
+from oracle_server import OracleServer, RemoteOracle, close_oracle, serve
 
 def b642hex(s):
     """
@@ -106,6 +117,19 @@ def valid_pkcs7_padding(s):
     else:
         raise Exception('Not a valid PKCS#7 encoding for string %s' % s)
 
+def likely_bytes():
+    """
+    FROM: set2/challenge12
+    """
+
+    common = (' etaoinshrdlcumwfgypbvkjxqz'
+              'ETAOINSHRDLCUMWFGYPBVKJXQZ'
+              '\n.,\'-?!"0123456789:;/()')
+    rest = [chr(i) for i in range(256) if chr(i) not in common]
+    plausible = is_plausible_batch(rest)
+    return (list(common) + [c for c, ok in zip(rest, plausible) if ok]
+            + [c for c, ok in zip(rest, plausible) if not ok])
+
 def rand_bytes(strlen):
     """
     FROM: set2/challenge11
@@ -169,8 +193,14 @@ class Webserver:
         'MDAwMDA5aXRoIG15IHJhZy10b3AgZG93biBzbyBteSBoYWlyIGNhbiBibG93'
     ]
 
-    def __init__(self):
+    def __init__(self, latency=0):
+        """
+        @param latency [float]: Seconds each padding check takes, to simulate
+                                a server on the other end of a network
+        """
+
         self.__key = rand_bytes(16)
+        self.__latency = latency
 
     def choose_random_string(self):
         """
@@ -192,6 +222,8 @@ class Webserver:
                         otherwise
         """
 
+        if self.__latency:
+            time.sleep(self.__latency)
         pt = aes_cbc_decrypt(self.__key, ct, iv)
         try:
             return valid_pkcs7_padding(pt)
@@ -199,7 +231,290 @@ class Webserver:
                              # padding is not valid
             return False
 
-def decrypt(server, ct, iv):
+class PipelinedOracle:
+    """
+    Keeps many padding checks in flight at once. A pool of @concurrency worker
+    threads, each with its own oracle handle from @connect (e.g. its own
+    connection to a remote oracle), takes checks off a shared queue, starting
+    no more than @rate checks per second between them.
+
+    first_valid() queues a whole list of candidate CTs, most likely first, and
+    returns as soon as any of them has valid padding. Checks still waiting in
+    the queue are cancelled at that point. With a round trip time of RTT, a
+    search that would take k sequential checks takes about
+    k / @concurrency * RTT instead (at the cost of up to @concurrency - 1
+    wasted checks). Checks already in flight when a search returns still
+    reach the oracle; the queries attribute counts every check that did,
+    across all searches.
+
+    If a worker can't get an oracle handle (or a check fails), the error is
+    raised by the search it was working for, unless another check found a
+    valid padding first. The worker tries to connect again for its next
+    check.
+    """
+
+    def __init__(self, connect, concurrency=16, rate=None):
+        """
+        @param connect [function]: Returns a new oracle handle
+        @param concurrency [int]: Maximum number of checks in flight
+        @param rate [float]: Maximum number of checks started per second (no
+                             limit by default)
+        """
+
+        self.__connect = connect
+        self.__rate = rate
+        self.__tasks = Queue.Queue()
+        self.__lock = threading.Condition()
+        self.queries = 0 # Padding checks that reached the oracle
+        self.__next_start = 0.0 # Earliest time the next check can start
+        self.__workers = [threading.Thread(target=self.__work)
+                          for _ in range(concurrency)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+
+    def __throttle(self):
+        if not self.__rate:
+            return
+        with self.__lock:
+            now = time.time()
+            start = max(now, self.__next_start)
+            self.__next_start = start + 1.0 / self.__rate
+        time.sleep(start - now)
+
+    def __work(self):
+        server = None
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                close_oracle(server)
+                return
+            search, idx, ct, iv = task
+            valid, error, checked = False, None, False
+            if search['result'] is None:
+                try:
+                    if server is None:
+                        server = self.__connect()
+                    self.__throttle()
+                    checked = True
+                    valid = server.valid_padding(ct, iv)
+                except Exception, e:
+                    error = e
+                    close_oracle(server)
+                    server = None # The handle may be broken
+            with self.__lock:
+                search['pending'] -= 1
+                if checked:
+                    self.queries += 1
+                    search['queries'] += 1
+                if search['result'] is None:
+                    if valid:
+                        search['result'] = idx
+                    elif error:
+                        search['error'] = error
+                self.__lock.notify_all()
+
+    def first_valid(self, cts, iv):
+        """
+        @param cts [list]: CTs to check, most likely to be valid first
+        @param iv [str]: IV to send with every padding check
+        @returns [tuple]: ([int], [int]), where t[0] is the index of a CT in
+                          @cts with valid padding (or None if there isn't one)
+                          and t[1] is the number of padding checks made by
+                          the time it returned (see the queries attribute).
+        """
+
+        search = {'result': None, 'error': None, 'pending': len(cts),
+                  'queries': 0}
+        for idx, ct in enumerate(cts):
+            self.__tasks.put((search, idx, ct, iv))
+        with self.__lock:
+            while (search['result'] is None and search['error'] is None
+                   and search['pending'] > 0):
+                self.__lock.wait()
+            result = search['result']
+            search['result'] = -1 # Leave the queued checks for the workers to
+                                  # skip
+        if result is None and search['error']:
+            raise search['error']
+        return (result, search['queries'])
+
+    def valid_padding(self, ct, iv):
+        return self.first_valid([ct], iv)[0] == 0
+
+    def close(self):
+        """
+        Stops the workers once the checks they're making are done, closing
+        their oracle handles (see oracle_server.close_oracle()).
+        """
+
+        for _ in self.__workers:
+            self.__tasks.put(None)
+        for worker in self.__workers:
+            worker.join()
+
+def first_valid_padding(server, cts, iv):
+    """
+    Finds a CT in @cts with valid padding. A PipelinedOracle checks many of
+    them at once. Any other oracle checks them one at a time, in order, and
+    stops at the first valid one.
+
+    @param server [Webserver]: Padding oracle
+    @param cts [list]: CTs to check, most likely to be valid first
+    @param iv [str]: IV to send with every padding check
+    @returns [tuple]: ([int], [int]), where t[0] is the index of a CT in @cts
+                      with valid padding (or None if there isn't one) and
+                      t[1] is the number of padding checks made.
+    """
+
+    if isinstance(server, PipelinedOracle):
+        return server.first_valid(cts, iv)
+    for idx, ct in enumerate(cts):
+        if server.valid_padding(ct, iv):
+            return (idx, idx + 1)
+    return (None, len(cts))
+
+def recover_intermediate(server, block, iv, guesses=None, known='',
+                         nbytes=None, state=None):
+    """
+    Recovers the intermediate state I = D_k(@block) of a CT block with the
+    padding oracle, one byte at a time from the last byte. With the trailing
+    bytes I[j+1:] known, set the fake previous block C' so that
+    C'[j+1:] = I[j+1:] XOR v, where v = blocksize - j is the target pad value,
+    and try C'[j] = g XOR v for each guess g of I[j]. The padding of
+    C' || @block is valid when P'[j:] = v...v, i.e. when g = I[j].
+
+    The last byte is the only one where a valid padding can be a false
+    positive: if P'[-2] happens to be \x02, then P'[-1] = \x02 is valid too
+    (and so on for longer pads). Changing C'[-2] changes P'[-2], so one extra
+    query with C'[-2] modified tells the cases apart.
+
+    @param server [Webserver]: Padding oracle
+    @param block [str]: CT block
+    @param iv [str]: IV to send with every padding check
+    @param guesses [function]: Returns the guesses g of I[j] [list of int],
+                               most likely first, given j (0x00 to 0xff in
+                               order by default)
+    @param known [str]: Trailing bytes of I, if they're already known
+    @param nbytes [int]: Number of bytes to recover (all of them by default)
+    @param state [AttackState]: Attack state to record each recovered byte
+                                and the oracle queries in (see
+                                resume_intermediate())
+    @returns [tuple]: ([str], [int]), where t[0] is the recovered trailing
+                      bytes of I (including @known) and t[1] is the number of
+                      oracle queries made.
+    """
+
+    blocksize = len(block)
+    guesses = guesses or (lambda byteidx: range(256))
+    nbytes = blocksize - len(known) if nbytes is None else nbytes
+    inter = known
+    queries = 0
+    for byteidx in range(blocksize-len(known)-1, blocksize-len(known)-nbytes-1,
+                         -1):
+        pad = blocksize - byteidx
+        prefix = '\x00' * byteidx
+        suffix = xorstr(inter, chr(pad) * len(inter))
+        candidates = list(guesses(byteidx))
+        byte_queries = 0
+        while True:
+            fakes = [prefix + chr(guess ^ pad) + suffix + block
+                     for guess in candidates]
+            idx, search_queries = first_valid_padding(server, fakes, iv)
+            byte_queries += search_queries
+            if idx is None:
+                raise Exception('No valid padding found for byte %d.'
+                                % byteidx)
+            if pad == 1 and byteidx > 0:
+                # Rule out a longer pad
+                fake = fakes[idx]
+                fake = (fake[:byteidx-1] + chr(ord(fake[byteidx-1]) ^ 1)
+                        + fake[byteidx:])
+                byte_queries += 1
+                if not server.valid_padding(fake, iv):
+                    # Carry on from the next candidate. The ones before it
+                    # were ruled out (unless a pipelined search returned
+                    # before checking them all), so they go last.
+                    candidates = candidates[idx+1:] + candidates[:idx]
+                    continue
+            inter = chr(candidates[idx]) + inter
+            break
+        queries += byte_queries
+        if state:
+            state.byteidx = byteidx - 1
+            state.block = fakes[idx][:blocksize]
+            state.query(byte_queries)
+    return (inter, queries)
+
+def resume_intermediate(state, blocksize):
+    """
+    Returns the trailing bytes of the intermediate state that an interrupted
+    recover_intermediate() had recovered. The fake block C' that last got a
+    valid padding for byte j has C'[j:] = I[j:] XOR v, v = blocksize - j, so
+    the state only needs to keep C' and the index of the next byte j - 1.
+
+    @param state [AttackState]: Attack state
+    @param blocksize [int]: Blocksize of the cipher
+    @returns [str]: Recovered trailing bytes of I ('' if there aren't any)
+    """
+
+    if state.block is None:
+        return ''
+    byteidx = state.byteidx + 1
+    pad = blocksize - byteidx
+    return xorstr(state.block[byteidx:], chr(pad) * pad)
+
+def decrypt_block(server, prev_block, block, iv, last=False, known='',
+                  state=None):
+    """
+    Recovers the PT of the CT block @block (C_i) using the padding oracle.
+    The attack only needs @block and the CT block before it, @prev_block
+    (C_i-1), so blocks can be attacked independently. See decrypt() for the
+    approach.
+
+    Since P_i = I_i XOR C_i-1, guessing a PT byte is the same as guessing an
+    intermediate byte, so the guesses are ordered by how likely each PT byte
+    is (see likely_bytes()). The PT of the last block ends in PKCS#7 padding
+    chr(p)*p, so for its last byte the pad values are guessed first, and once
+    p is known the other p - 1 padding bytes come for free.
+
+    @param server [Webserver]: Padding oracle
+    @param prev_block [str]: Previous CT block C_i-1 (the IV for the first
+                             block)
+    @param block [str]: CT block C_i
+    @param iv [str]: IV to send with every padding check
+    @param last [bool]: True if @block is the last (padded) block of the CT
+    @param known [str]: Trailing bytes of I_i, if they're already known
+    @param state [AttackState]: Attack state to record progress in
+    @returns [tuple]: ([str], [int]), where t[0] is the PT block P_i and t[1]
+                      is the number of oracle queries made.
+    """
+
+    def guesses(order):
+        return lambda byteidx: [ord(prev_block[byteidx]) ^ ord(c)
+                                for c in order]
+
+    blocksize = len(block)
+    candidates = likely_bytes()
+    queries = 0
+    if last:
+        if not known:
+            pads = [chr(p) for p in range(1, blocksize+1)]
+            known, queries = recover_intermediate(
+                server, block, iv,
+                guesses(pads + [c for c in candidates if c not in pads]),
+                nbytes=1, state=state
+            )
+        pad = ord(known[-1]) ^ ord(prev_block[-1])
+        if len(known) < pad:
+            known = xorstr(prev_block[-pad:], chr(pad) * pad)
+    inter, block_queries = recover_intermediate(server, block, iv,
+                                                guesses(candidates), known,
+                                                state=state)
+    return (xorstr(inter, prev_block), queries + block_queries)
+
+def decrypt(server, ct, iv, workers=1, connect=None, resume_from=None,
+            interval=1000):
     """
     Approach:
     Consider the CBC decryption algorithm:
@@ -224,7 +539,37 @@ def decrypt(server, ct, iv):
            to equal \x02\x02).
     Repeat this for the rest of the bytes in the block, checking if the
     modified byte of the ith CT returns a valid PT (with padding chr(i) * i).
-    Do this for all blocks, using the IV as C_0 to get the block P_1.
+    Do this for all blocks, using the IV as C_0 to get the block P_1. (See
+    recover_intermediate(), which works with D_k(C_i) directly, and
+    decrypt_block(), which guesses likely PT bytes first.)
+
+    Since the attack on block i only needs the pair (C_i-1, C_i), the blocks
+    are independent and can be attacked in parallel by a pool of @workers
+    threads. When the oracle's latency dominates, an n-block CT takes about as
+    long as a single block. Each worker thread gets its own oracle handle from
+    @connect (e.g. its own connection to a remote oracle); the results are
+    stitched back together in block order.
+
+    If @resume_from is given, progress is kept in an AttackState that's saved
+    there every @interval queries: the PT of the blocks decrypted so far, the
+    block and byte being attacked and the fake block C' that last got a valid
+    padding (see resume_intermediate()). If it already holds a checkpoint for
+    the same CT, the attack picks up at the byte where it stopped. The
+    checkpoint only has room for one block in progress, so the blocks are
+    attacked in order and @workers is ignored (passing a PipelinedOracle as
+    @server still keeps many checks in flight).
+
+    @param server [Webserver]: Padding oracle
+    @param ct [str]: ASCII CT
+    @param iv [str]: IV used to encrypt the PT
+    @param workers [int]: Number of blocks to attack in parallel
+    @param connect [function]: Returns a new oracle handle for each worker
+                               thread (by default the workers share @server)
+    @param resume_from [str]: Checkpoint file path
+    @param interval [int]: Number of queries between checkpoints
+    @returns [tuple]: ([str], [int]), where t[0] is the PT and t[1] is the
+                      total number of oracle queries made (including any made
+                      before resuming).
     """
 
     def strip_padding(s):
@@ -234,44 +579,166 @@ def decrypt(server, ct, iv):
 
         return s[:-ord(s[-1])]
 
+    def attack(blockidx):
+        if not hasattr(handles, 'server'):
+            handles.server = connect() if connect else server
+        return decrypt_block(handles.server, ct_blocks[blockidx-1],
+                             ct_blocks[blockidx], iv,
+                             last=(blockidx == len(ct_blocks)-1))
+
     blocksize = len(iv)
     ct_blocks = [iv] + [ct[i:i+blocksize]                      # List of block
                         for i in range(0, len(ct), blocksize)] # strings
-    pt_blocks = []
-    for blockidx in range(len(ct_blocks)-1, 0, -1):
-        ct_blocks_mod = ct_blocks[:]
-        pt_block = ''
-        for byteidx in range(15, -1, -1):
-            for testchar in map(chr, range(256)):
-                # Tweak the character at the index given by blockidx, byteidx
-                ct_blocks_mod[blockidx-1] = (
-                    ct_blocks_mod[blockidx-1][:byteidx]
-                    + testchar
-                    + ct_blocks_mod[blockidx-1][byteidx+1:]
-                )
-                if server.valid_padding(
-                    ''.join(ct_blocks_mod[blockidx-1:blockidx+1]),
-                    iv
-                ):
-                    pt_byte = xorstr(xorstr(ct_blocks[blockidx-1][byteidx],
-                                            chr(16 - byteidx)),
-                                     testchar)
-                    pt_block = pt_byte + pt_block
-                    # Update the rest of the block for the next byte.
-                    # Currently, our CT is correctly padded to find \0x01. We
-                    # want to tweak the trailing bytes to find \0x02.
-                    ct_blocks_mod[blockidx-1] = (
-                        ct_blocks_mod[blockidx-1][:byteidx]
-                        + ''.join([xorstr(xorstr(chr(16 - byteidx),
-                                                 chr(16 - byteidx + 1)),
-                                          currchar)
-                                   for currchar
-                                   in ct_blocks_mod[blockidx-1][byteidx:]]))
-                    break
-        pt_blocks = [pt_block] + pt_blocks
-    return strip_padding(''.join(pt_blocks))
+    handles = threading.local() # Each worker thread's oracle handle
+    if resume_from:
+        state = AttackState.load(resume_from, interval)
+        state.resume((iv + ct).encode('hex'))
+        state.blockidx = state.blockidx or 1
+        while state.blockidx < len(ct_blocks):
+            pt_block, _ = decrypt_block(
+                server, ct_blocks[state.blockidx-1],
+                ct_blocks[state.blockidx], iv,
+                last=(state.blockidx == len(ct_blocks)-1),
+                known=resume_intermediate(state, blocksize), state=state
+            )
+            state.recovered += pt_block
+            state.blockidx += 1
+            state.byteidx = blocksize - 1
+            state.block = None
+        state.save()
+        return (strip_padding(state.recovered), state.queries)
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(attack, range(1, len(ct_blocks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(attack, range(1, len(ct_blocks)))
+    pt_blocks, queries = zip(*results)
+    return (strip_padding(''.join(pt_blocks)), sum(queries))
+
+def forge(server, pt, blocksize=16, resume_from=None, interval=1000):
+    """
+    Forges a CT (and IV) that decrypts to @pt, using only the padding oracle.
+    Consider the CBC decryption algorithm again:
+        P_i = D_k(C_i) XOR C_i-1; C_0 = IV
+    For any block C_i, the padding oracle gives us D_k(C_i) (see
+    recover_intermediate()), so setting C_i-1 = D_k(C_i) XOR P_i makes C_i
+    decrypt to any P_i we like. Start with a random last block C_n and work
+    backwards to C_0, which becomes the IV.
+
+    Each block is one recover_intermediate() call, so passing a
+    PipelinedOracle as @server keeps many checks in flight. The blocks can't
+    be attacked in parallel since each one depends on the one after it, and
+    D_k of a random block is uniformly distributed, so there's no likelihood
+    order to exploit.
+
+    Recovering a block takes ~2000 queries. If @resume_from is given,
+    progress is kept in an AttackState that's saved there every @interval
+    queries and after every block: the blocks forged so far (including the
+    random C_n, which must survive an interruption) and the progress of
+    recover_intermediate() on the current block. A forgery of the same PT
+    resumes at the byte where it stopped.
+
+    @param server [Webserver]: Padding oracle
+    @param pt [str]: PT to forge a CT for
+    @param blocksize [int]: Blocksize of the cipher
+    @param resume_from [str]: Checkpoint file path
+    @param interval [int]: Number of queries between checkpoints
+    @returns [tuple]: ([str], [str], [int]), where t[0] is the forged CT,
+                      t[1] is the IV to send with it and t[2] is the number of
+                      oracle queries made (including any made before
+                      resuming).
+    """
+
+    padded_pt = pkcs7_pad(pt, blocksize)
+    pt_blocks = [padded_pt[i:i+blocksize]
+                 for i in range(0, len(padded_pt), blocksize)]
+    state = AttackState.load(resume_from, interval)
+    state.resume(padded_pt.encode('hex'))
+    if not state.recovered:
+        state.recovered = rand_bytes(blocksize) # C_i || ... || C_n
+        state.blockidx = len(pt_blocks) # Forging C_blockidx-1
+        state.byteidx = blocksize - 1
+
+    iv = '\x00' * blocksize # Any IV works for the two-block padding checks
+    while state.blockidx > 0:
+        inter, _ = recover_intermediate(
+            server, state.recovered[:blocksize], iv,
+            known=resume_intermediate(state, blocksize), state=state
+        )
+        state.recovered = (xorstr(inter, pt_blocks[state.blockidx-1])
+                           + state.recovered)
+        state.blockidx -= 1
+        state.byteidx = blocksize - 1
+        state.block = None
+        if resume_from:
+            state.save()
+    return (state.recovered[blocksize:], state.recovered[:blocksize],
+            state.queries)
+
+def benchmark_pipeline(rtts=(0.001, 0.005, 0.02), concurrency=(1, 16, 64)):
+    """
+    Decrypts a CT from a local HTTP padding oracle (see misc/oracle_server.py)
+    with a simulated round trip time per padding check, through a
+    PipelinedOracle with each level of concurrency, and prints the
+    throughput. Every worker connects to the same session, so they all query
+    the Webserver that encrypted the CT.
+
+    @param rtts [list]: Simulated round trip times (seconds)
+    @param concurrency [list]: Numbers of checks to keep in flight
+    """
+
+    print '%8s %12s %8s %8s %12s' % ('RTT (s)', 'concurrency', 'queries',
+                                     'time (s)', 'queries/s')
+    for rtt in rtts:
+        httpd, address = serve(OracleServer(latency=rtt))
+        session = rand_bytes(16).encode('hex')
+        connect = lambda: RemoteOracle(address, 'challenge17', session)
+        try:
+            server = connect()
+            ct, iv = server.choose_random_string()
+            server.close()
+            for n in concurrency:
+                pipeline = PipelinedOracle(connect, concurrency=n)
+                try:
+                    start = time.time()
+                    decrypt(pipeline, ct, iv)
+                    elapsed = time.time() - start
+                finally:
+                    pipeline.close()
+                queries = pipeline.queries # Including checks still in flight
+                                           # when their search returned
+                print '%8.3f %12d %8d %8.2f %12.1f' % (rtt, n, queries,
+                                                       elapsed,
+                                                       queries / elapsed)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
 
 if __name__=='__main__':
     server = Webserver()
     ct, iv = server.choose_random_string()
-    print decrypt(server, ct, iv)
+    pt, queries = decrypt(server, ct, iv)
+    print pt
+    print 'Oracle queries: %d (%.2f per byte)' % (queries,
+                                                 float(queries) / len(ct))
+
+    # With a simulated 1ms round trip per padding check, attacking every block
+    # at once takes about as long as attacking one.
+    server = Webserver(latency=0.001)
+    ct, iv = server.choose_random_string()
+    for workers in [1, len(ct) / len(iv)]:
+        start = time.time()
+        pt = decrypt(server, ct, iv, workers=workers)[0]
+        print '%d worker(s): %.2fs %s' % (workers, time.time() - start, pt)
+
+    # Forge a CT for a PT of our choosing, then decrypt it with the oracle
+    ct, iv, queries = forge(server, 'Forged with nothing but a padding oracle')
+    print decrypt(server, ct, iv)[0]
+
+    # Against a padding oracle over HTTP, keeping many checks in flight hides
+    # most of the round trip time.
+    benchmark_pipeline(rtts=(0.005,), concurrency=(1, 16))
@@ -34,31 +34,220 @@ Points for automating this, but part of the reason I'm having you do this is
 that I think this approach is suboptimal.
 """
 
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'misc'))
+from byteclass import BYTE_CLASSES, CLASS_SCORES, RARE
 from challenge17 import b642hex, rand_bytes, xorstr
 from challenge18 import aes_ctr_encrypt, aes_ctr_decrypt
 
-def charscore(c):
-    """
-    FROM: set1/challenge3
-    """
-
-    # +1 if string is in the set of characters or spaces
-    positive_set = set(range(ord('a'), ord('a')+26) + [ord(' ')])
-    # -1 if the string is in the set of rarely used characters:
-    #   128, 153, 161-255
-    negative_set = set([128] + [153] + range(161, 255))
-    # -99 if the string is in the set of unused characters:
-    #   0-8, 11-31, 127, 129-152, 154-160
-    unused_set = set(range(0, 9) + range(11, 32) + [127] + range(129, 153)
-                     + range(154, 161))
-    if ord(c) in positive_set:
-        return 1
-    elif ord(c) in negative_set:
-        return -9
-    elif ord(c) in unused_set:
-        return -99
-    else:
-        return 0
+def charweights():
+    """
+    @returns [np.array]: Score of every byte's class (see misc/byteclass.py),
+                         indexed by byte value
+    """
+
+    return CLASS_SCORES[BYTE_CLASSES]
+
+def score_table(weights=None):
+    """
+    @param weights [np.array]: Weight of each PT byte (charweights() by
+                               default)
+    @returns [np.array]: 256 x 256 table X, where X[b][k] = W[b XOR k] is the
+                         weight of CT byte b decrypted with keystream byte k
+                         (see score_columns()). The default table is built
+                         once, as SCORE_TABLE.
+    """
+
+    if weights is None:
+        return SCORE_TABLE
+    return weights[np.arange(256)[:, np.newaxis] ^ np.arange(256)]
+
+SCORE_TABLE = score_table(charweights())
+
+def stack_cts(cts):
+    """
+    Stacks CTs of different lengths into a ragged matrix, row i holding CT i
+    padded with zeros, and a mask of the bytes that are really there.
+
+    @param cts [list]: CTs
+    @returns [tuple]: ([np.array], [np.array]), where t[0] is the uint8
+                      matrix (|@cts| x max CT length) and t[1] is the boolean
+                      mask, True where the matrix holds a CT byte.
+    """
+
+    lengths = np.array(map(len, cts))
+    maxlen = lengths.max() if len(cts) else 0
+    mask = np.arange(maxlen) < lengths[:, np.newaxis]
+    matrix = np.zeros(mask.shape, dtype=np.uint8)
+    matrix[mask] = np.frombuffer(''.join(cts), dtype=np.uint8) # Row order
+    return (matrix, mask)
+
+def column_histograms(matrix, mask):
+    """
+    @param matrix [np.array]: CT matrix (see stack_cts())
+    @param mask [np.array]: Mask of the CT bytes in @matrix
+    @returns [np.array]: (max CT length x 256) matrix H, where H[j][b] is the
+                         number of CTs with byte b at index j
+    """
+
+    maxlen = matrix.shape[1]
+    cols = np.nonzero(mask)[1]
+    return np.bincount(cols * 256 + matrix[mask], minlength=maxlen * 256
+                       ).reshape(maxlen, 256)
+
+def score_columns(histograms, weights=None):
+    """
+    Scores every keystream byte k for every column j at once. The score of k
+    is the total weight of the PT bytes it gives, sum_i W[C_i[j] XOR k], which
+    only depends on how many times each CT byte b appears in the column:
+        S[j][k] = sum_b H[j][b] * W[b XOR k]
+    So with the 256 x 256 table X[b][k] = W[b XOR k], S = H . X is one matrix
+    product, whatever the number of CTs.
+
+    @param histograms [np.array]: Column histograms (see column_histograms())
+    @param weights [np.array]: Weight of each PT byte (charweights() by
+                               default)
+    @returns [np.array]: (max CT length x 256) matrix of scores
+    """
+
+    return histograms.dot(score_table(weights))
+
+def best_keystream(scores):
+    """
+    @param scores [np.array]: Scores of every keystream byte for every column
+                              (see score_columns())
+    @returns [tuple]: ([str], [np.array]), where t[0] is the best scoring
+                      keystream and t[1] is the margin of each byte over the
+                      second best candidate for its column (0 means a tie, so
+                      the larger the margin the more confident the guess)
+    """
+
+    keystream = scores.argmax(axis=1)
+    top2 = np.sort(scores, axis=1)[:, -2:]
+    return (keystream.astype(np.uint8).tostring(), top2[:, 1] - top2[:, 0])
+
+def solve_keystream(cts, weights=None):
+    """
+    Recovers the keystream shared by CTs encrypted with a reused CTR nonce.
+    For all i, P_i = C_i XOR E_k(keystream), so each keystream byte is the
+    candidate that turns its column of CT bytes into the most plausible PT
+    bytes. All 256 candidates for all columns are scored in one pass (see
+    score_columns()), so this takes O(total CT length) plus a constant per
+    column, and handles tens of thousands of CTs in well under a second.
+
+    @param cts [list]: CTs encrypted with the same keystream
+    @param weights [np.array]: Weight of each PT byte (charweights() by
+                               default)
+    @returns [tuple]: ([str], [np.array]), where t[0] is the keystream (as
+                      long as the longest CT) and t[1] is the confidence
+                      margin of each byte (see best_keystream())
+    """
+
+    matrix, mask = stack_cts(cts)
+    return best_keystream(score_columns(column_histograms(matrix, mask),
+                                        weights))
+
+def bigram_table(matrix, mask, keystream, min_coverage=10, smoothing=0.5):
+    """
+    Estimates log P(b | a), the log probability that PT byte b follows PT byte
+    a, from the CTs themselves: they're decrypted with @keystream, and the
+    byte pairs in columns covered by at least @min_coverage CTs (where the
+    keystream guess is reliable) are counted.
+
+    @param matrix [np.array]: CT matrix (see stack_cts())
+    @param mask [np.array]: Mask of the CT bytes in @matrix
+    @param keystream [str]: Keystream estimate (see solve_keystream())
+    @param min_coverage [int]: Minimum number of CTs covering both columns of
+                               a pair for the pair to be counted
+    @param smoothing [float]: Count added to every pair
+    @returns [np.array]: 256 x 256 matrix L, where L[a][b] = log P(b | a)
+    """
+
+    pts = matrix ^ np.frombuffer(keystream, dtype=np.uint8)
+    trusted = mask.sum(axis=0) >= min_coverage
+    pairs = mask[:, 1:] & trusted[:-1] & trusted[1:]
+    codes = pts[:, :-1][pairs].astype(np.int64) * 256 + pts[:, 1:][pairs]
+    counts = np.bincount(codes, minlength=65536).reshape(256, 256)
+    counts = counts + smoothing
+    return np.log(counts / counts.sum(axis=1, keepdims=True))
+
+def refine_keystream(cts, width=16, branch=64, prune=1, min_coverage=10,
+                     weights=None):
+    """
+    Guessing each keystream byte independently (see solve_keystream()) goes
+    wrong in the tail columns, where only a few CTs are long enough to vote
+    and many candidates tie. Neighbouring PT bytes aren't independent,
+    though, so this searches over whole keystreams instead, scoring each by
+        sum_j S[j][k_j] + sum_j sum_i L[P_i[j-1]][P_i[j]]
+    where S is the per-column score (see score_columns()), L is the bigram
+    log likelihood (see bigram_table()) and P_i[j] = C_i[j] XOR k_j, over all
+    the CTs i covering column j.
+
+    The search is a beam search from the first column to the last, keeping
+    the @width best partial keystreams. Each is extended with the candidates
+    for the next column scoring within @prune of its best candidate (at most
+    @branch of them), so confident columns only branch a little. Candidates
+    that decrypt any CT byte in the column to a RARE or UNUSED byte (see
+    misc/byteclass.py) are dropped first, unless every candidate does. Each
+    extension is scored in one vectorized step over the distinct
+    (C_i[j-1], C_i[j]) pairs in the column, weighted by how often they
+    occur.
+
+    @param cts [list]: CTs encrypted with the same keystream
+    @param width [int]: Number of partial keystreams kept
+    @param branch [int]: Maximum number of candidates tried for each column
+    @param prune [int]: Candidates scoring more than @prune below the best for
+                        their column aren't tried
+    @param min_coverage [int]: See bigram_table()
+    @param weights [np.array]: Weight of each PT byte (charweights() by
+                               default)
+    @returns [str]: The keystream (as long as the longest CT)
+    """
+
+    matrix, mask = stack_cts(cts)
+    histograms = column_histograms(matrix, mask)
+    scores = score_columns(histograms, weights)
+    keystream, _ = best_keystream(scores)
+    bigrams = bigram_table(matrix, mask, keystream, min_coverage)
+
+    keys = np.arange(256, dtype=np.uint8)
+    beams = np.zeros((1, 0), dtype=np.uint8) # Partial keystreams
+    totals = np.zeros(1)                     # and their scores
+    for j in range(matrix.shape[1]):
+        # The column decrypted with each of the 256 keys (each distinct CT
+        # byte in the column once), classified as a (256 x bytes) matrix
+        present = np.flatnonzero(histograms[j]).astype(np.uint8)
+        plausible = (BYTE_CLASSES[keys[:, np.newaxis] ^ present]
+                     < RARE).all(axis=1)
+        order = np.argsort(-scores[j], kind='mergesort')
+        if plausible.any():
+            order = order[plausible[order]]
+        order = order[scores[j][order] >= scores[j][order[0]] - prune]
+        candidates = order[:branch].astype(np.uint8)
+        extended = totals[:, np.newaxis] + scores[j][candidates]
+        if j > 0:
+            rows = mask[:, j]
+            codes, counts = np.unique(
+                matrix[rows, j-1].astype(np.int64) * 256 + matrix[rows, j],
+                return_counts=True
+            )
+            prev = (codes >> 8).astype(np.uint8)
+            curr = (codes & 0xff).astype(np.uint8)
+            # (beam x candidate x pair) bigram log likelihoods
+            likelihoods = bigrams[
+                prev ^ beams[:, -1][:, np.newaxis, np.newaxis],
+                curr ^ candidates[np.newaxis, :, np.newaxis]
+            ]
+            extended += likelihoods.dot(counts)
+        best = np.argsort(-extended, axis=None, kind='mergesort')[:width]
+        beamidx, candidx = np.unravel_index(best, extended.shape)
+        beams = np.hstack([beams[beamidx],
+                           candidates[candidx][:, np.newaxis]])
+        totals = extended.ravel()[best]
+    return beams[0].tostring()
 
 class SessionOracle:
 
@@ -121,29 +310,17 @@ def decrypt():
         Note that for all i, P_i = C_i XOR E_k(keystream_i). So, let's try to
         guess E_k(keystream_i). For all characters 256 possible characters of
         E_k, pick the one where E_k XOR C_i produces the most legitimate
-        characters (potential P_i) over all C_i. Do this for all characters.
+        characters (potential P_i) over all C_i. Do this for all characters
+        (see solve_keystream()), then fix up the columns only a few CTs are
+        long enough to vote on using which characters tend to follow each
+        other (see refine_keystream()).
 
     @returns [list]: A list of decrypted ASCII PTs
     """
 
     oracle = SessionOracle()
     cts = oracle.get_encrypted_strings()
-    maxlen = max(map(len, cts))
-    # Pick Pn to be the longest string
-    longeststr = [s for s in cts if len(s) == maxlen][0] # Pick the first one
-    enc_keystream = '' # Encrypted keystream E_k
-    # Figure out the PT for the longest string
-    for stri in range(maxlen):
-        cscores = []
-        for c in map(chr, range(256)):
-            cscore = sum([charscore(xorstr(ct[stri], c))
-                          for ct in cts if len(ct) > stri
-                          and ct != longeststr])
-            cscores.append((c, cscore))
-        # Pick the first character with the max score
-        enc_keystream += \
-            sorted(cscores, key=lambda x: x[1], reverse=True)[0][0]
-
+    enc_keystream = refine_keystream(cts) # Encrypted keystream E_k
     # Figure out the PT for the CTs using the estimated E_k as input
     pts = [xorstr(enc_keystream[:len(ct)], ct) for ct in cts]
     return pts
@@ -18,9 +18,15 @@ Solve the resulting concatenation of ciphertexts as if for repeating- key XOR,
 with a key size of the length of the ciphertext you XOR'd.
 """
 
+import ctypes
+import multiprocessing
+import timeit
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
 from challenge17 import b642hex, rand_bytes, xorstr
 from challenge18 import aes_ctr_encrypt, aes_ctr_decrypt
-from challenge19 import charscore
+from challenge19 import (solve_keystream, refine_keystream, score_table,
+                         column_histograms, score_columns, best_keystream)
 
 class SessionOracle:
 
@@ -42,46 +48,271 @@ class SessionOracle:
                                 b642hex(s).decode('hex'),
                                 self.__nonce) for s in self.__strings]
 
-def decrypt():
+class KeystreamEstimator:
     """
-    Instantiates a new SessionOracle and gets the list of all encrypted CTs.
-    Using these CTs, it figures out the corresponding PTs. Approach:
+    Estimates the keystream of a reused CTR nonce online, as CTs arrive. The
+    solve only needs each column's histogram of CT bytes (see
+    challenge19.score_columns()), so the CTs themselves aren't kept: add()
+    updates the histograms in O(|CT|) and marks the columns it touched, and
+    only those columns are re-scored the next time the keystream is needed.
+    Memory is O(max CT length x 256) however many CTs have been added.
+    """
+
+    def __init__(self, weights=None):
+        """
+        @param weights [np.array]: Weight of each PT byte
+                                   (challenge19.charweights() by default)
+        """
+
+        self.__table = score_table(weights)
+        self.__histograms = np.zeros((0, 256), dtype=np.int64)
+        self.__scores = np.zeros((0, 256), dtype=np.int64)
+        self.__dirty = np.zeros(0, dtype=bool) # Columns to re-score
+        self.__length = 0 # Length of the longest CT added
+        self.count = 0    # Number of CTs added
+
+    def __grow(self, length):
+        """
+        Makes room for columns up to @length, at least doubling the capacity
+        so growing is amortized O(1) per column.
+        """
+
+        capacity = max(length, 2 * len(self.__histograms))
+        extra = capacity - len(self.__histograms)
+        self.__histograms = np.vstack([self.__histograms,
+                                       np.zeros((extra, 256), np.int64)])
+        self.__scores = np.vstack([self.__scores,
+                                   np.zeros((extra, 256), np.int64)])
+        self.__dirty = np.concatenate([self.__dirty,
+                                       np.zeros(extra, dtype=bool)])
+
+    def add(self, ct):
+        """
+        Adds a CT encrypted with the keystream being estimated.
+
+        @param ct [str]: CT
+        """
+
+        if len(ct) > len(self.__histograms):
+            self.__grow(len(ct))
+        cols = np.arange(len(ct))
+        self.__histograms[cols, np.frombuffer(ct, dtype=np.uint8)] += 1
+        self.__dirty[:len(ct)] = True
+        self.__length = max(self.__length, len(ct))
+        self.count += 1
+
+    def estimate(self):
+        """
+        Re-scores the columns changed since the last estimate.
+
+        @returns [tuple]: ([str], [np.array]), where t[0] is the best keystream
+                          so far (as long as the longest CT added) and t[1] is
+                          the confidence margin of each byte (see
+                          challenge19.best_keystream())
+        """
+
+        dirty = np.nonzero(self.__dirty)[0]
+        if len(dirty):
+            self.__scores[dirty] = self.__histograms[dirty].dot(self.__table)
+            self.__dirty[dirty] = False
+        return best_keystream(self.__scores[:self.__length])
+
+    def decrypt(self, ct):
+        """
+        Decrypts @ct with the current keystream estimate. Bytes past the
+        longest CT added so far can't be decrypted and are dropped.
+
+        @param ct [str]: CT
+        @returns [str]: PT
+        """
+
+        keystream, _ = self.estimate()
+        return xorstr(keystream[:len(ct)], ct[:len(keystream)])
+
+class SharedCTs:
+    """
+    CTs stacked into a matrix in shared memory (sharedctypes.RawArray), so
+    worker processes forked after it's built can read it without copying or
+    pickling anything. The CTs are sorted longest first, so the CTs covering
+    column j are the first coverage[j] rows of the matrix.
+        matrix: Raw uint8 (|CTs| x max CT length) matrix
+        lengths: Raw int64 length of each row
+        shape: Shape of the matrix
+    """
+
+    def __init__(self, cts):
+        """
+        @param cts [list]: CTs encrypted with the same keystream
+        """
+
+        cts = sorted(cts, key=len, reverse=True)
+        self.shape = (len(cts), len(cts[0]) if cts else 0)
+        self.matrix = RawArray(ctypes.c_uint8, self.shape[0] * self.shape[1])
+        self.lengths = RawArray(ctypes.c_int64, self.shape[0])
+        matrix, lengths = self.arrays()
+        lengths[:] = map(len, cts)
+        mask = np.arange(self.shape[1]) < lengths[:, np.newaxis]
+        matrix[mask] = np.frombuffer(''.join(cts), dtype=np.uint8)
+
+    def arrays(self):
+        """
+        @returns [tuple]: ([np.array], [np.array]), NumPy views of the matrix
+                          and the row lengths
+        """
+
+        matrix = np.frombuffer(self.matrix, dtype=np.uint8)
+        lengths = np.frombuffer(self.lengths, dtype=np.int64)
+        return (matrix.reshape(self.shape), lengths)
+
+    def coverage(self):
+        """
+        @returns [np.array]: Number of CTs covering each column
+        """
+
+        _, lengths = self.arrays()
+        return np.searchsorted(-lengths, -np.arange(self.shape[1]),
+                               side='left')
+
+def solve_columns(shared, start, stop, keystream, margins, weights=None):
+    """
+    Solves the keystream bytes for columns @start to @stop - 1 (see
+    challenge19.solve_keystream()) from the shared CTs and writes them into
+    the shared @keystream and @margins arrays.
+
+    @param shared [SharedCTs]: Shared CTs
+    @param start [int]: First column
+    @param stop [int]: Column after the last one
+    @param keystream [RawArray]: Shared uint8 keystream
+    @param margins [RawArray]: Shared int64 confidence margins
+    @param weights [np.array]: Weight of each PT byte
+                               (challenge19.charweights() by default)
+    """
+
+    if start >= stop:
+        return
+    matrix, lengths = shared.arrays()
+    rows = np.count_nonzero(lengths > start) # The CTs covering @start
+    mask = np.arange(start, stop) < lengths[:rows, np.newaxis]
+    histograms = column_histograms(matrix[:rows, start:stop], mask)
+    keys, margin = best_keystream(score_columns(histograms, weights))
+    np.frombuffer(keystream, dtype=np.uint8)[start:stop] = np.frombuffer(
+        keys, dtype=np.uint8
+    )
+    np.frombuffer(margins, dtype=np.int64)[start:stop] = margin
+
+def solve_keystream_sharded(cts, processes=None, weights=None, shared=None):
+    """
+    Solves the keystream like challenge19.solve_keystream(), with the
+    columns split between @processes worker processes. The CT matrix lives in
+    shared memory (see SharedCTs) and each worker writes its columns straight
+    into a shared keystream array, so the only things passed to a worker are
+    its column range and the shared buffers, which are inherited when it's
+    forked. Early columns are covered by more CTs than late ones, so the
+    ranges are split to give each worker about the same number of CT bytes.
+
+    @param cts [list]: CTs encrypted with the same keystream
+    @param processes [int]: Number of worker processes (one per CPU by
+                            default)
+    @param weights [np.array]: Weight of each PT byte
+                               (challenge19.charweights() by default)
+    @param shared [SharedCTs]: The CTs already in shared memory, if they are
+    @returns [tuple]: ([str], [np.array]), where t[0] is the keystream and
+                      t[1] is the confidence margin of each byte
+    """
+
+    processes = processes or multiprocessing.cpu_count()
+    shared = shared or SharedCTs(cts)
+    maxlen = shared.shape[1]
+    keystream = RawArray(ctypes.c_uint8, maxlen)
+    margins = RawArray(ctypes.c_int64, maxlen)
+    work = np.cumsum(shared.coverage())
+    bounds = [0] + [int(np.searchsorted(work, work[-1] * i / processes))
+                    for i in range(1, processes)] + [maxlen]
+    workers = [multiprocessing.Process(target=solve_columns,
+                                       args=(shared, bounds[i], bounds[i+1],
+                                             keystream, margins, weights))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # A crashed worker leaves its columns zeroed, which would look valid
+    for worker in workers:
+        if worker.exitcode != 0:
+            raise Exception('Keystream worker exited with code %d'
+                            % worker.exitcode)
+    return (np.frombuffer(keystream, dtype=np.uint8).tostring(),
+            np.frombuffer(margins, dtype=np.int64).copy())
+
+def benchmark_sharded(copies=10000, processes=(1, 2, 4, 8)):
+    """
+    Solves @copies copies of the challenge CTs with each number of worker
+    processes and prints how the solve time scales. Building the shared
+    matrix is single-threaded and timed separately.
+    """
+
+    cts = SessionOracle().get_encrypted_strings() * copies
+    start = timeit.default_timer()
+    shared = SharedCTs(cts)
+    print 'Stacked %d CTs (%.1f MB) in %.2fs on %d CPU(s)' % (
+        len(cts), len(shared.matrix) / 1e6, timeit.default_timer() - start,
+        multiprocessing.cpu_count()
+    )
+    print '%9s %8s %8s' % ('processes', 'time (s)', 'speedup')
+    baseline = None
+    for n in processes:
+        duration = timeit.timeit(
+            lambda: solve_keystream_sharded(cts, n, shared=shared), number=1
+        )
+        baseline = baseline or duration
+        print '%9d %8.2f %7.2fx' % (n, duration, baseline / duration)
+
+def decrypt(cts=None):
+    """
+    Instantiates a new SessionOracle and gets the list of all encrypted CTs
+    (unless @cts are given). Using these CTs, it figures out the
+    corresponding PTs. Approach:
         Note that for all i, P_i = C_i XOR E_k(keystream_i). Then, for all
         (PT, CT) pairs (PTn, CTn), Pn_i XOR Cn_i = Pm_i XOR Cm_i. So, we can
-        guess each character of Pn_i and check that character against the 39
-        other CTs. We'll take the highest score out of all 256 possible Pn_i
-        and use that to find the rest of the Pm_i (Cn_i XOR Pn_i XOR Cm_i). Do
-        this for all characters in all blocks. This should give us pretty
-        reliable results for the first characters, but less reliable results
-        for long strings, where there are fewer candidates to XOR against.
+        guess each character of the keystream and check that character
+        against all the CTs, taking the highest score out of all 256
+        candidates (see challenge19.solve_keystream()). This should give us
+        pretty reliable results for the first characters, but less reliable
+        results for long strings, where there are fewer candidates to XOR
+        against, so those columns are refined using which characters tend to
+        follow each other (see challenge19.refine_keystream()).
 
+    @param cts [list]: CTs encrypted with the same keystream
     @returns [list]: A list of decrypted ASCII PTs
     """
 
-    oracle = SessionOracle()
-    cts = oracle.get_encrypted_strings()
-    maxlen = max(map(len, cts))
-    # Pick Pn to be the longest string
-    longeststr = [s for s in cts if len(s) == maxlen][0] # Pick the first one
-    pt_n = ''
-    # Figure out the PT for the longest string
-    for stri in range(maxlen):
-        cscores = []
-        for c in map(chr, range(256)):
-            cscore = sum([charscore(xorstr(xorstr(c, longeststr[stri]),
-                                           ct[stri]))
-                          for ct in cts if len(ct) > stri
-                          and ct != longeststr])
-            cscores.append((c, cscore))
-        # Pick the first character with the max score
-        pt_n += sorted(cscores, key=lambda x: x[1], reverse=True)[0][0]
-    
-    # Figure out the PT for the rest of the strings
-    pts = [xorstr(xorstr(longeststr[:len(ct)], pt_n[:len(ct)]), ct)
-           for ct in cts]
-    return pts
+    if cts is None:
+        cts = SessionOracle().get_encrypted_strings()
+    keystream = refine_keystream(cts)
+    return [xorstr(keystream[:len(ct)], ct) for ct in cts]
 
 if __name__ == '__main__':
     pts = decrypt()
     for pt in pts:
         print pt
+
+    # Solve a large corpus of CTs encrypted with the same keystream
+    cts = SessionOracle().get_encrypted_strings() * 500
+    duration = timeit.timeit(lambda: solve_keystream(cts), number=1)
+    print 'Solved %d CTs in %.3fs' % (len(cts), duration)
+
+    # Estimate the keystream as the CTs arrive
+    estimator = KeystreamEstimator()
+    start = timeit.default_timer()
+    for idx, ct in enumerate(cts):
+        estimator.add(ct)
+        if idx in (2, 9, 59):
+            print '%5d CTs: %r' % (idx + 1, estimator.decrypt(cts[0]))
+    duration = timeit.default_timer() - start
+    print 'Added %d CTs in %.3fs (%.0f CTs/s)' % (len(cts), duration,
+                                                  len(cts) / duration)
+    print estimator.estimate()[0] == solve_keystream(cts)[0]
+
+    # Solve a much larger corpus across processes
+    print solve_keystream_sharded(cts)[0] == solve_keystream(cts)[0]
+    benchmark_sharded()
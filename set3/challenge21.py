@@ -16,14 +16,25 @@ Unsurprisingly, the paper does a much better job of explaining the algorithm
 than the corresponding Wikipedia article.
 """
 
-class Random():
+import random
+import timeit
+import numpy as np
+
+class Random(object):
     """
     Generates a 32-bit pseudorandom number (randint()). It can also generate a
     32-bit pseudorandom double (rand()). First, initialize the generator with
     a seed. Successive calls to rand() or randint() will be pseudorandom from
-    that seed.
+    that seed. randints(n) and rand(n) return the next n outputs at once as
+    NumPy arrays.
+
+    Each instance keeps its own state, so any number of generators can run
+    side by side. The whole state vector is twisted (and tempered) at once
+    every n outputs rather than one word per output.
     """
 
+    __slots__ = ('__mt', '__out', '__i')
+
     # Constants:
 
     # For seed generation:
@@ -31,26 +42,27 @@ class Random():
     __genm = int('ffffffff', 16) # Generation bitmask
     __genp = 69069               # Generation multiplier
 
-    # For the recurrence:
-    __w = 32  # Word size
-    __n = 624 # Number of words in the word vector (degree of recurrence)
-    __m = 397 # Offset of previously comparable word vector
-    __r = 31  # Number of bits of the lower bitmask
-    __umask = int(hex(2 ** __r)[2:], 16)     # Upper bitmask
-    __lmask = int(hex(2 ** __r - 1)[2:], 16) # Lower bitmask
-    __a = int('9908b0df', 16) # Coefficients of the last row in vector matrix A
+    # For the recurrence (public, with recur(), temper() and the tempering
+    # constants below, so challenge 23 can invert and check them):
+    __w = 32 # Word size
+    N = 624  # Number of words in the word vector (degree of recurrence)
+    M = 397  # Offset of previously comparable word vector
+    __r = 31 # Number of bits of the lower bitmask
+    UMASK = int(hex(2 ** __r)[2:], 16)     # Upper bitmask
+    LMASK = int(hex(2 ** __r - 1)[2:], 16) # Lower bitmask
+    A = int('9908b0df', 16) # Coefficients of the last row in vector matrix A
 
-    # For the tempering transform:
-    __b = int('9d2c5680', 16) # Tempering bitmask
-    __c = int('efc60000', 16) # Tempering bitmask
-    __u = 11 # First tempering bitshift
-    __s = 7  # Tempering bitshift
-    __t = 15 # Tempering bitshift
-    __l = 18 # Last tempering bitshift
+    # For seeding many generators at once: 69069^i mod 2^32 for every word i
+    # of the state vector (uint32 products wrap around mod 2^32)
+    __genpowers = np.cumprod([1] + [__genp] * (N - 1), dtype=np.uint32)
 
-    # State:
-    __mt = [0] * __n # The (n_w)-byte state vector (n vectors of w bytes)
-    __i = 0          # The index of the state vector
+    # For the tempering transform:
+    B = int('9d2c5680', 16) # Tempering bitmask
+    C = int('efc60000', 16) # Tempering bitmask
+    U = 11 # First tempering bitshift
+    S = 7  # Tempering bitshift
+    T = 15 # Tempering bitshift
+    L = 18 # Last tempering bitshift
 
     def __init__(self, seed=__default):
         """
@@ -64,12 +76,116 @@ class Random():
                            truncates the input to 32 bits.
         """
 
-        seed = self.__default if seed == 0 else seed
-        self.__mt[0] = seed & self.__genm
-        for i in range(1, self.__n):
-            self.__mt[i] = (self.__genp * self.__mt[i-1]) & self.__genm
+        # State:
+        self.__mt = self.seed_states([seed])[0] # The (n_w)-byte state vector
+                                                # (n words of w bits)
+        self.__out = None  # The tempered outputs of the current state vector
+        self.__i = self.N # The index of the next output. The state vector
+                          # is twisted before the first output.
+
+    @classmethod
+    def seed_states(cls, seeds):
+        """
+        Seeds many generators at once. The seeding recurrence in __init__()
+        has the closed form
+            mt[i] = (69069^i * seed) & 0xffffffff
+        so every state vector is one row of the outer product of the seeds
+        with the (precomputed) powers of 69069, computed in uint32 so the
+        products wrap around mod 2^32. Seeds of 0 are replaced by the default
+        seed, as in __init__().
+
+        Each state vector takes 2.5kB, so seed very large ranges in chunks.
+
+        @param seeds [list|np.array]: Seeds (any integers)
+        @returns [np.array]: (len(@seeds) x 624) uint32 matrix whose rows are
+                             the initial state vectors
+        """
+
+        return np.outer(cls.__seed_words(seeds), cls.__genpowers)
+
+    @classmethod
+    def from_state(cls, mt):
+        """
+        Builds a generator from a state vector, e.g. one recovered from its
+        outputs. The recurrence only relates words to the words before them,
+        so @mt can be any n consecutive words of a generator's stream, not
+        just a whole state vector.
+
+        @param mt [list|np.array]: n consecutive 32-bit state words
+        @returns [Random]: Generator whose next output is the one after the
+                           outputs of @mt
+        """
+
+        mt = np.array(mt, dtype=np.uint32)
+        if mt.shape != (cls.N,):
+            raise Exception('Expected %d state words' % cls.N)
+        rand = cls.__new__(cls)
+        rand.__mt = mt
+        rand.__out = None
+        rand.__i = cls.N
+        return rand
+
+    @classmethod
+    def nth_outputs(cls, seeds, k=0):
+        """
+        Computes the @k-th output (counting from 0) of a generator seeded
+        with each of @seeds, without building the generators. For k < n-m,
+        output k only depends on the initial words mt[k], mt[k+1] and
+        mt[k+m] (see __twist()), so only those 3 words are seeded (in closed
+        form, see seed_states()), recurred and tempered, across all seeds at
+        once.
+
+        @param seeds [list|np.array]: Seeds (any integers)
+        @param k [int]: Index of the output, 0 <= @k < 227
+        @returns [np.array]: uint32 array of the @k-th output of each seed
+        """
+
+        if not 0 <= k < cls.N - cls.M:
+            raise Exception('Output %d depends on twisted words' % k)
+        seeds = cls.__seed_words(seeds)
+        powers = cls.__genpowers
+        return cls.temper(cls.recur(seeds * powers[k],
+                                    seeds * powers[k+1],
+                                    seeds * powers[k+cls.M]))
+
+    @classmethod
+    def __seed_words(cls, seeds):
+        """
+        @param seeds [list|np.array]: Seeds (any integers)
+        @returns [np.array]: uint32 array of the first state word (mt[0]) of
+                             each seed
+        """
+
+        seeds = np.asarray(seeds)
+        seeds = np.where(seeds == 0, cls.__default, seeds)
+        return (seeds & cls.__genm).astype(np.uint32)
+
+    @classmethod
+    def recur(cls, x, xnext, xm):
+        """
+        @param x [np.array]: Words x_k
+        @param xnext [np.array]: Words x_k+1
+        @param xm [np.array]: Words x_k+m
+        @returns [np.array]: Words x_k+n = x_k+m ^ (x^u_k | x^l_k+1) A
+        """
+
+        mid = (x & cls.UMASK) | (xnext & cls.LMASK)
+        return xm ^ (mid >> 1) ^ ((mid & 1) * np.uint32(cls.A))
+
+    @classmethod
+    def temper(cls, x):
+        """
+        @param x [np.array]: Words
+        @returns [np.array]: Tempered words y = xT
+        """
+
+        y = x ^ (x >> cls.U)
+        y ^= (y << cls.S) & cls.B
+        y ^= (y << cls.T) & cls.C
+        y ^= y >> cls.L
+        return y
 
-    def __generate(self):
+    def __twist(self):
         """
         Implemented as described in the paper (section 2):
 
@@ -109,43 +225,99 @@ class Random():
                 4. y := y ^ (y >> l)
             4. Return y
 
-        Note: Notationally, what is described here as x is the list mt in the
+        Note: Notationally, what is described here as x is the array mt in the
               code.
 
-        @returns [int]: Pseudorandom 32-bit integer
+        All n words are regenerated at once. x_k+n depends on x_k+m, which
+        has itself been regenerated when k+m >= n, so the recurrence is
+        applied in slices of n-m words: each slice only reads words of the
+        previous slice. The last word also reads the regenerated x_n (its
+        x^l_k+1), which is ready once the first slice is done.
         """
 
-        # Recurrence
-        mid = ((self.__mt[self.__i] & self.__umask) # (x^u_k | x^l_k+1)
-               | (self.__mt[(self.__i + 1) % self.__n] & self.__lmask))
-        a = 0 if int('00000001', 16) & mid == 0 else self.__a
-        self.__mt[self.__i] = (self.__mt[(self.__i + self.__m) % self.__n]
-                               ^ (mid >> 1) ^ a)
+        n, m = self.N, self.M
+        old = self.__mt
+        mt = np.empty_like(old)
 
-        # Tempering function
-        y = self.__mt[self.__i]
-        y ^= y >> self.__u
-        y ^= (y << self.__s) & self.__b
-        y ^= (y << self.__t) & self.__c
-        y ^= y >> self.__l
+        # Recurrence: (x^u_k | x^l_k+1) A for every k, with x_k+m = 0 so
+        # it can be XORed in per slice. The last word's x^l_k+1 is fixed up
+        # once the first word has been regenerated.
+        zeros = np.zeros_like(old)
+        xa = self.recur(old, np.roll(old, -1), zeros)
+        mt[:n-m] = old[m:] ^ xa[:n-m]
+        xa[-1] = self.recur(old[-1:], mt[:1], zeros[:1])[0]
+        for start in range(n - m, n, n - m):
+            stop = min(start + n - m, n)
+            mt[start:stop] = mt[start-n+m:stop-n+m] ^ xa[start:stop]
 
-        self.__i += 1
-        self.__i %= self.__n
-        return y
+        self.__mt = mt
+        self.__out = self.temper(mt)
+        self.__i = 0
 
-    def rand(self):
+    def rand(self, n=None):
         """
-        @returns [float]: Pseudorandom 32-bit float
+        @param n [int]: Number of outputs, or None for a single output
+        @returns [float|np.array]: Pseudorandom 32-bit float, or an array of
+                                   @n of them
         """
 
-        return float(self.__generate()) / int('ffffffff', 16)
+        if n is None:
+            return float(self.randint()) / int('ffffffff', 16)
+        return self.randints(n) / float(int('ffffffff', 16))
 
     def randint(self):
         """
         @returns [int]: Pseudorandom 32-bit integer
         """
 
-        return self.__generate()
+        if self.__i == self.N:
+            self.__twist()
+        self.__i += 1
+        return int(self.__out[self.__i - 1])
+
+    def randints(self, n):
+        """
+        @param n [int]: Number of outputs
+        @returns [np.array]: The next @n pseudorandom 32-bit integers (uint32)
+        """
+
+        chunks = []
+        while n > 0:
+            if self.__i == self.N:
+                self.__twist()
+            size = min(n, self.N - self.__i)
+            chunks.append(self.__out[self.__i:self.__i+size])
+            self.__i += size
+            n -= size
+        return np.concatenate(chunks) if chunks else np.empty(0, np.uint32)
+
+def benchmark(words=10**6):
+    """
+    Prints how many 32-bit words per second Random generates one at a time
+    (randint()) and in bulk (randints()), next to the standard library's
+    MT19937 (random.getrandbits(32)), and how many state vectors per second
+    seed_states() seeds.
+
+    @param words [int]: Number of words to generate per method
+    """
+
+    rand = Random(5489)
+    methods = [
+        ('Random.randint()', lambda: [rand.randint() for _ in xrange(words)]),
+        ('Random.randints()', lambda: rand.randints(words)),
+        ('random.getrandbits(32)',
+         lambda: [random.getrandbits(32) for _ in xrange(words)])
+    ]
+    print '%-24s %14s' % ('method', 'words/s')
+    for name, method in methods:
+        duration = timeit.timeit(method, number=1)
+        print '%-24s %14.0f' % (name, words / duration)
+
+    seeds = np.arange(1, 86401) # A day's worth of timestamp seeds
+    duration = timeit.timeit(lambda: Random.seed_states(seeds), number=1)
+    print 'Seeded %d states in %.3fs (%.0f states/s)' % (
+        len(seeds), duration, len(seeds) / duration
+    )
 
 if __name__=='__main__':
     seed = int(raw_input('Enter a seed value: '))
@@ -153,3 +325,4 @@ if __name__=='__main__':
     for _ in range(10):
         print rand.rand()
         print rand.randint()
+    benchmark()
@@ -17,27 +17,305 @@ time, although you're missing some of the fun of this exercise if you do that.
 From the 32 bit RNG output, discover the seed.
 """
 
+import ctypes
+import json
+import multiprocessing
+import os
+import tempfile
 import time
+import timeit
+import numpy as np
 from challenge21 import Random
 
-def recover_timestamp_seed(randint):
+def recover_timestamp_seed(randint, window=None, now=None, k=0,
+                           batch=2**20):
     """
     Recover a MT19937 seed from an integer seeded by a timestamp. Starting with
     the current timestamp, check previous timestamps until you find one that
     produces the same random integer. That is your seed.
 
+    Rather than building a generator per timestamp, the candidate timestamps
+    are checked @batch at a time, computing only the state words the
+    integer depends on (see challenge21.Random.nth_outputs()).
+
     @param randint [int]: Random 32-bit integer
+    @param window [int]: Number of seconds to search back from @now, or None
+                         to search back to the epoch
+    @param now [int]: Latest candidate timestamp (defaults to the current
+                      time)
+    @param k [int]: Index of @randint in the generator's output (0 for the
+                    first output, up to 226)
+    @param batch [int]: Number of timestamps to check per batch
     @returns [int]: The seed that generated that integer
     """
 
-    currTime = int(time.time())
-    while currTime > 0:
-        if Random(currTime).randint() == randint:
-            return currTime
-        currTime -= 1
+    now = int(time.time()) if now is None else now
+    stop = 0 if window is None else max(now - window, 0)
+    while now > stop:
+        seeds = np.arange(now, max(now - batch, stop), -1)
+        matches = np.flatnonzero(Random.nth_outputs(seeds, k) == randint)
+        if len(matches):
+            return int(seeds[matches[0]])
+        now -= batch
     # We somehow failed to find the seed. Maybe it wasn't seeded by timestamp?
     return
 
+def match_seeds(seeds, outputs, max_offset=0):
+    """
+    Finds a seed among @seeds whose output stream contains the sequence
+    @outputs, starting at some offset of at most @max_offset. The first
+    observed output is checked against output k of every seed at once (see
+    challenge21.Random.nth_outputs()) for each possible offset k, and the
+    (rare) seeds that pass are checked against the whole sequence with a
+    full generator.
+
+    @param seeds [np.array]: Candidate seeds
+    @param outputs [list]: Consecutive observed 32-bit outputs
+    @param max_offset [int]: Largest possible index of @outputs[0] in the
+                             output stream (< 227)
+    @returns [tuple]: (seed, offset) of the first match, or None
+    """
+
+    for offset in range(max_offset + 1):
+        firsts = Random.nth_outputs(seeds, offset)
+        for idx in np.flatnonzero(firsts == outputs[0]):
+            seed = int(seeds[idx])
+            stream = Random(seed).randints(offset + len(outputs))
+            if list(stream[offset:]) == list(outputs):
+                return (seed, offset)
+    return None
+
+def search_worker(outputs, max_offset, cursor, stop, searched, found,
+                  cancel, target=0.1):
+    """
+    Repeatedly claims the next chunk of seeds from the shared @cursor and
+    checks it with match_seeds(), until the seeds run out or @cancel is set.
+    Chunks start small and are resized after each one to take about
+    @target seconds, so progress updates and cancellation stay responsive
+    however fast the worker is.
+
+    @param outputs [list]: Consecutive observed 32-bit outputs
+    @param max_offset [int]: Largest possible offset of @outputs
+    @param cursor [Value]: Shared next unclaimed seed
+    @param stop [int]: One past the last seed to search
+    @param searched [Value]: Shared number of seeds searched
+    @param found [Array]: Shared (seed, offset) of the match, (-1, -1) if none
+    @param cancel [Event]: Set once a match is found (or to stop the search)
+    @param target [float]: Target seconds per chunk
+    """
+
+    size = 2**12
+    while not cancel.is_set():
+        with cursor.get_lock():
+            lo = cursor.value
+            hi = min(lo + size, stop)
+            cursor.value = hi
+        if lo >= stop:
+            return
+
+        start = timeit.default_timer()
+        match = match_seeds(np.arange(lo, hi, dtype=np.int64), outputs,
+                            max_offset)
+        elapsed = timeit.default_timer() - start
+        with searched.get_lock():
+            searched.value += hi - lo
+        if match is not None:
+            with found.get_lock():
+                if found[0] < 0:
+                    found[:] = match
+            cancel.set()
+            return
+        size = int(min(max(size * target / max(elapsed, 1e-6), 2**12),
+                       2**22))
+
+def print_progress(searched, total, rate):
+    """
+    Default progress callback for search_seeds().
+
+    @param searched [int]: Seeds searched so far
+    @param total [int]: Seeds to search
+    @param rate [float]: Seeds searched per second so far
+    """
+
+    print '%5.1f%% %d/%d seeds (%.1fM seeds/s)' % (
+        100.0 * searched / total, searched, total, rate / 1e6
+    )
+
+def search_seeds(outputs, start=0, stop=2**32, max_offset=0, processes=None,
+                 interval=1.0, progress=print_progress):
+    """
+    Searches seeds @start to @stop - 1 for one whose output stream contains
+    @outputs (see match_seeds()), across @processes worker processes (see
+    search_worker()). Workers claim chunks of seeds from a shared cursor
+    until one of them finds a match, which cancels the others. Only shared
+    counters are passed to the workers, which are inherited when they are
+    forked. While the workers run, @progress is called every @interval
+    seconds (and once more at the end) with the number of seeds searched,
+    the number to search and the rate so far. If a worker crashes, the seeds
+    it claimed were never searched, so an Exception is raised rather than
+    reporting that no seed matched.
+
+    Checking each possible offset costs as much as searching the range once,
+    so the search takes (@max_offset + 1) times as long. A core checks about
+    30M seeds per second per offset, so all 2^32 seeds take about 2.5
+    minutes of CPU time per offset, split between the workers.
+
+    @param outputs [list]: Consecutive observed 32-bit outputs
+    @param start [int]: First seed to search
+    @param stop [int]: One past the last seed to search
+    @param max_offset [int]: Largest possible index of @outputs[0] in the
+                             output stream (< 227)
+    @param processes [int]: Number of worker processes (one per CPU by
+                            default)
+    @param interval [float]: Seconds between progress updates
+    @param progress [function]: Progress callback, or None
+    @returns [tuple]: (seed, offset) of the match, or None
+    """
+
+    if not outputs:
+        raise Exception('No outputs to match')
+    if not 0 <= max_offset < 227:
+        raise Exception('Offset %d depends on twisted words' % max_offset)
+    processes = processes or multiprocessing.cpu_count()
+    cursor = multiprocessing.Value(ctypes.c_int64, start)
+    searched = multiprocessing.Value(ctypes.c_int64, 0)
+    found = multiprocessing.Array(ctypes.c_int64, [-1, -1])
+    cancel = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=search_worker,
+                                       args=(list(outputs), max_offset,
+                                             cursor, stop, searched, found,
+                                             cancel))
+               for _ in range(processes)]
+    begin = timeit.default_timer()
+    for worker in workers:
+        worker.start()
+    try:
+        running = True
+        while running:
+            # Wait until every worker has exited or @interval has passed
+            deadline = timeit.default_timer() + interval
+            for worker in workers:
+                worker.join(max(deadline - timeit.default_timer(), 0))
+            running = any(worker.is_alive() for worker in workers)
+            if progress is not None:
+                elapsed = timeit.default_timer() - begin
+                progress(searched.value, stop - start,
+                         searched.value / max(elapsed, 1e-6))
+    finally:
+        cancel.set()
+        for worker in workers:
+            worker.join()
+    # A crashed worker drops the seeds it claimed, so "not found" can't be
+    # trusted
+    for worker in workers:
+        if worker.exitcode != 0:
+            raise Exception('Seed search worker exited with code %d'
+                            % worker.exitcode)
+    return tuple(found) if found[0] >= 0 else None
+
+class SeedIndex:
+    """
+    Reverse index from the k-th MT19937 output to the seeds that produce it,
+    for a fixed range of seeds (e.g. a year of timestamps), so that repeated
+    recoveries over the same range are a binary search instead of a search.
+
+    The index is stored on disk as a .npy file holding a (2 x n) uint32
+    array: the outputs of every seed in the range, sorted, and the seed that
+    produced each one. It is opened memory-mapped, so a lookup only reads the
+    pages its binary search touches. The seed range and output index are
+    stored alongside in @path.json.
+
+    Each seed takes 8 bytes on disk, so a year of timestamps (31.5M seeds)
+    takes 252MB. Building it takes about 8 bytes of memory per seed (plus
+    the pages of the file being written) and about 8s on a single core,
+    mostly sorting. A lookup takes about 30us.
+    """
+
+    def __init__(self, path):
+        """
+        Opens an index built by build().
+
+        @param path [str]: Path of the index (.npy) file
+        """
+
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.path = path
+        self.start = meta['start'] # First seed in the range
+        self.stop = meta['stop']   # One past the last seed in the range
+        self.k = meta['k']         # Index of the output (0 for the first)
+        self.__index = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self.__index.shape[1]
+
+    @classmethod
+    def build(cls, path, start, stop, k=0, batch=2**20):
+        """
+        Computes the @k-th output of every seed in [@start, @stop) (see
+        challenge21.Random.nth_outputs()), sorts the (output, seed) pairs by
+        output and writes them to @path. Both files are written to temporary
+        files first and renamed into place, so an interrupted build never
+        leaves a partial index behind.
+
+        @param path [str]: Path of the index (.npy) file
+        @param start [int]: First seed in the range
+        @param stop [int]: One past the last seed in the range (< 2^32)
+        @param k [int]: Index of the output, 0 <= @k < 227
+        @param batch [int]: Number of seeds to compute outputs for at once
+        @returns [SeedIndex]: The opened index
+        """
+
+        if not 0 <= start < stop <= 2**32:
+            raise Exception('Invalid seed range [%d, %d)' % (start, stop))
+
+        # Pack each pair as output << 32 | (seed - start), so that a single
+        # in-place sort orders the pairs by output and then by seed
+        pairs = np.empty(stop - start, dtype=np.uint64)
+        for lo in range(0, len(pairs), batch):
+            offsets = np.arange(lo, min(lo + batch, len(pairs)),
+                                dtype=np.uint64)
+            outputs = Random.nth_outputs(offsets.astype(np.int64) + start, k)
+            pairs[lo:lo+len(offsets)] = (outputs.astype(np.uint64) << 32
+                                         | offsets)
+        pairs.sort()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        index = np.lib.format.open_memmap(tmppath, mode='w+', dtype=np.uint32,
+                                          shape=(2, len(pairs)))
+        for lo in range(0, len(pairs), batch):
+            chunk = pairs[lo:lo+batch]
+            index[0, lo:lo+len(chunk)] = chunk >> 32
+            index[1, lo:lo+len(chunk)] = (chunk & 0xffffffff) + start
+        index.flush()
+        del index
+        os.rename(tmppath, path)
+
+        fd, tmppath = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'start': start, 'stop': stop, 'k': k}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, path + '.json')
+        return cls(path)
+
+    def lookup(self, output):
+        """
+        Binary searches the index for @output.
+
+        @param output [int]: The @k-th output of the generator (32 bits)
+        @returns [list]: Every seed in the range that produces @output, in
+                         increasing order
+        """
+
+        # Search with a uint32, or NumPy casts the whole index to compare
+        output = np.uint32(output)
+        lo = np.searchsorted(self.__index[0], output, side='left')
+        hi = np.searchsorted(self.__index[0], output, side='right')
+        return map(int, self.__index[1][lo:hi])
+
 if __name__=='__main__':
     # (Sort of but not really) random time from 0 to 30 seconds
     randsecs = Random(int(time.time() * 13791)).randint() % 30
@@ -50,3 +328,37 @@ if __name__=='__main__':
     time.sleep(randsecs)
     print 'Recovering...'
     print 'Recovered seed: %s' % recover_timestamp_seed(randint)
+
+    # Search a whole day's worth of timestamps
+    now = int(time.time())
+    randint = Random(now - 86399).randint()
+    duration = timeit.timeit(
+        lambda: recover_timestamp_seed(randint, window=86400, now=now),
+        number=1
+    )
+    print 'Searched 24 hours of timestamps in %.4fs' % duration
+
+    # Index a week of timestamps once, then look seeds up
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'week.npy')
+    start = timeit.default_timer()
+    index = SeedIndex.build(path, now - 7 * 86400, now + 1)
+    print 'Indexed %d seeds in %.2fs (%.1f MB)' % (
+        len(index), timeit.default_timer() - start,
+        os.path.getsize(path) / 1e6
+    )
+    duration = timeit.timeit(lambda: index.lookup(randint), number=1000)
+    print 'Lookup: %s in %.1fus' % (index.lookup(randint), duration * 1000)
+    del index
+    os.remove(path)
+    os.remove(path + '.json')
+    os.rmdir(directory)
+
+    # Find a seed from a few outputs seen at an unknown point of its stream
+    seed = Random(int(time.time())).randint() % 2**25
+    outputs = list(Random(seed).randints(8)[3:8])
+    start = timeit.default_timer()
+    print 'Found (seed, offset): %s (planted %s)' % (
+        search_seeds(outputs, stop=2**25, max_offset=4), (seed, 3)
+    )
+    print 'Searched in %.2fs' % (timeit.default_timer() - start)
@@ -0,0 +1,164 @@
+"""
+Clone an MT19937 RNG from its output
+------------------------------------
+
+The internal state of MT19937 consists of 624 32 bit integers.
+
+For each batch of 624 outputs, MT permutes that internal state. By permuting
+state regularly, MT19937 achieves a period of 2**19937, which is Big.
+
+Each time MT19937 is tapped, an element of its internal state is subjected to
+a tempering function that diffuses bits through the result.
+
+The tempering function is invertible; you can write an "untemper" function
+that takes an MT19937 output and transforms it back into the corresponding
+element of the MT19937 state array.
+
+To invert the temper transform, apply the inverse of each of the operations in
+the temper transform in reverse order. There are two kinds of operations in
+the temper transform each applied twice; one is an XOR against a right-shifted
+value, and the other is an XOR against a left-shifted value AND'd with a magic
+number. So you'll need code to invert the "right" and the "left" operation.
+
+Once you have "untemper" working, create a new MT19937 generator, tap it for
+624 outputs, untemper each of them to recreate the state of the generator, and
+splice that state into a new instance of the MT19937 generator.
+
+The new "spliced" generator should predict the values of the original.
+
+Stop and think for a second.
+How would you modify MT19937 to make this attack hard? What would happen if you
+subjected each tempered output to a cryptographic hash?
+"""
+
+import time
+import timeit
+import numpy as np
+from challenge21 import Random
+
+N = Random.N # Number of words in the state vector
+
+def unshift_right(y, shift):
+    """
+    Inverts y = x ^ (x >> shift). The top @shift bits of y are the top bits
+    of x, which give the next @shift bits of x, and so on, so applying
+    x = y ^ (x >> shift) 32 // shift times (starting from x = y) recovers all
+    of x.
+
+    @param y [np.array]: uint32 words
+    @param shift [int]: Bitshift
+    @returns [np.array]: uint32 words x
+    """
+
+    x = y.copy()
+    for _ in range(32 // shift):
+        x = y ^ (x >> shift)
+    return x
+
+def unshift_left(y, shift, mask):
+    """
+    Inverts y = x ^ ((x << shift) & mask), the same way as unshift_right()
+    starting from the bottom bits.
+
+    @param y [np.array]: uint32 words
+    @param shift [int]: Bitshift
+    @param mask [np.uint32]: Bitmask
+    @returns [np.array]: uint32 words x
+    """
+
+    x = y.copy()
+    for _ in range(32 // shift):
+        x = y ^ ((x << shift) & mask)
+    return x
+
+def untemper(outputs):
+    """
+    Inverts the tempering transform (see challenge21.Random.temper()) by
+    undoing each of its steps in reverse order, across all outputs at once.
+
+    @param outputs [list|np.array]: 32-bit outputs
+    @returns [np.array]: uint32 state words that produced @outputs
+    """
+
+    x = np.asarray(outputs).astype(np.uint32)
+    x = unshift_right(x, Random.L)
+    x = unshift_left(x, Random.T, Random.C)
+    x = unshift_left(x, Random.S, Random.B)
+    return unshift_right(x, Random.U)
+
+def find_breaks(outputs):
+    """
+    Finds where a stream of outputs stops following from the outputs before
+    it, e.g. because the generator was reseeded or outputs went missing.
+    Every state word after the first n satisfies the recurrence
+        x_k+n = x_k+m ^ (x^u_k | x^l_k+1) A
+    so the stream is untempered and the recurrence (see
+    challenge21.Random.recur()) is checked for every k at once. After a break
+    at index j, the recurrence fails for the following n words too (their
+    inputs straddle the break), so a stream can be re-synced by cloning from
+    the outputs starting at the first index of a run of breaks (see
+    clone_from_outputs()).
+
+    @param outputs [list|np.array]: Consecutive 32-bit outputs
+    @returns [np.array]: Indices j >= n of the outputs that don't follow from
+                         the n outputs before them
+    """
+
+    x = untemper(outputs)
+    if len(x) <= N:
+        return np.empty(0, dtype=np.int64)
+    expected = Random.recur(x[:-N], x[1:len(x)-N+1],
+                            x[Random.M:len(x)-N+Random.M])
+    return np.flatnonzero(expected != x[N:]) + N
+
+def clone_from_outputs(outputs, offset=None):
+    """
+    Clones a generator from n consecutive outputs: untempering them gives n
+    consecutive state words, which is all the recurrence needs to generate
+    the rest of the stream (see challenge21.Random.from_state()). They don't
+    have to be aligned to a twist, so any n outputs will do.
+
+    The clone is built from the n outputs starting at @offset and then
+    advanced past the rest of @outputs, so its next output is the one after
+    the stream. By default the last n outputs are used, which works even if
+    the generator was reseeded earlier in the stream.
+
+    @param outputs [list|np.array]: Consecutive 32-bit outputs (at least n)
+    @param offset [int]: Index of the first output to clone from (defaults
+                         to len(@outputs) - n)
+    @returns [Random]: Generator predicting the outputs after @outputs
+    """
+
+    offset = len(outputs) - N if offset is None else offset
+    if not 0 <= offset <= len(outputs) - N:
+        raise Exception('Need %d outputs from offset %d (got %d)' % (
+            N, offset, len(outputs)
+        ))
+    rand = Random.from_state(untemper(outputs[offset:offset+N]))
+    skip = len(outputs) - offset - N
+    while skip > 0:
+        skip -= len(rand.randints(min(skip, 2**20)))
+    return rand
+
+if __name__=='__main__':
+    # Clone a generator from 624 of its outputs
+    rand = Random(int(time.time()))
+    clone = clone_from_outputs(rand.randints(N))
+    print 'Predicted: %s' % clone.randints(5)
+    print 'Actual:    %s' % rand.randints(5)
+
+    # Reseed partway through a long stream, then re-sync at the reseed
+    reseed = int(time.time()) + 1
+    stream = np.concatenate((rand.randints(2000000),
+                             Random(reseed).randints(1000001)))
+    start = timeit.default_timer()
+    breaks = find_breaks(stream)
+    print 'Checked %d outputs in %.2fs; breaks at %d-%d' % (
+        len(stream), timeit.default_timer() - start, breaks[0], breaks[-1]
+    )
+    start = timeit.default_timer()
+    clone = clone_from_outputs(stream, offset=breaks[0])
+    print 'Re-synced in %.2fs: %s' % (
+        timeit.default_timer() - start,
+        clone.randint() == Random(reseed).randints(1000002)[-1]
+    )
@@ -9,7 +9,9 @@ Re-implement the CBC bitflipping exercise from earlier to use CTR mode instead
 of CBC mode. Inject an "admin=true" token.
 """
 
-from challenge25 import rand_bytes, xorstr
+import timeit
+import numpy as np
+from challenge25 import rand_bytes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
@@ -57,10 +59,67 @@ class SessionOracle:
                 if len(tup) == 2 and tup[0] == 'admin' and tup[1] == 'true']
         return len(vals) > 0
 
-def ctr_bitflip(pt, ct, payload, offset=0):
+def ctr_patch(buf, offset, original, payload):
     """
     As discussed in challenge 25, due to the construction of CTR,
-    C XOR P = C' XOR P', where (P', C') are the modified PT/CT pair.
+    C XOR P = C' XOR P', where (P', C') are the modified PT/CT pair. Byte for
+    byte, C'[i] = C[i] XOR P[i] XOR P'[i], so only the bytes being changed
+    need to be known and touched. XORs the window of @buf at @offset with
+    @original XOR @payload in place, in O(|@payload|) whatever the size of
+    @buf.
+
+    @param buf [bytearray]: CT to modify in place (a bytearray or a writable
+                            memoryview)
+    @param offset [int]: Offset to insert the payload
+    @param original [str]: Original PT bytes at @offset
+    @param payload [str]: PT you want to insert at @offset
+    """
+
+    end = offset + len(payload)
+    if end > len(buf):
+        raise Exception('Payload of %d bytes at offset %d runs past the CT.'
+                        % (len(payload), offset))
+    window = bytearray(buf[offset:end])
+    for i in xrange(len(payload)):
+        window[i] ^= ord(original[i]) ^ ord(payload[i])
+    buf[offset:end] = window
+
+def ctr_patch_batch(records, patches):
+    """
+    Applies many patches to many CTs in place (see ctr_patch()). The XOR
+    deltas of all the patches are computed in one vectorized pass, then each
+    is applied to its window, so the cost is O(total payload size) plus a
+    constant per patch.
+
+    @param records [list]: CTs to modify in place (bytearrays or writable
+                           memoryviews)
+    @param patches [list]: Tuples of (record index, offset, original PT
+                           bytes, payload), one for each patch
+    """
+
+    if not patches:
+        return
+    _, _, originals, payloads = zip(*patches)
+    if map(len, originals) != map(len, payloads):
+        raise Exception('Each patch needs the original bytes it replaces.')
+    deltas = (np.frombuffer(''.join(originals), dtype=np.uint8)
+              ^ np.frombuffer(''.join(payloads), dtype=np.uint8))
+    start = 0
+    for recidx, offset, _, payload in patches:
+        end = offset + len(payload)
+        record = records[recidx]
+        if end > len(record):
+            raise Exception('Payload of %d bytes at offset %d runs past '
+                            'record %d.' % (len(payload), offset, recidx))
+        window = bytearray(record[offset:end])
+        np.frombuffer(window, dtype=np.uint8)[:] ^= deltas[start:start+
+                                                           len(payload)]
+        record[offset:end] = window
+        start += len(payload)
+
+def ctr_bitflip(pt, ct, payload, offset=0):
+    """
+    Returns a copy of @ct with @payload inserted (see ctr_patch()).
 
     @param pt [str]: Original PT
     @param ct [str]: Original CT
@@ -69,8 +128,10 @@ def ctr_bitflip(pt, ct, payload, offset=0):
     @returns [str]: CT corresponding to a PT embedded with @payload
     """
 
-    ptnew = (pt[:offset] + payload + pt[offset+len(payload):])[:len(pt)]
-    return xorstr(xorstr(pt, ct), ptnew)
+    payload = payload[:len(ct)-offset]
+    buf = bytearray(ct)
+    ctr_patch(buf, offset, pt[offset:offset+len(payload)], payload)
+    return str(buf)
 
 if __name__=='__main__':
     oracle = SessionOracle()
@@ -86,3 +147,26 @@ if __name__=='__main__':
     admin_ct = ctr_bitflip(initial_str, initial_ct, admin_payload)
     # Verify that admin is set to true
     print oracle.admin_exists(admin_ct)
+
+    # Patch a large record in place, knowing only the bytes being replaced
+    record = oracle.PREFIX + 'A' * (1 << 20) + oracle.SUFFIX
+    buf = bytearray(oracle.encrypt(record))
+    offset = len(oracle.PREFIX)
+    duration = timeit.timeit( # An even number of patches cancel out
+        lambda: ctr_patch(memoryview(buf), offset, 'A' * 12, admin_payload),
+        number=1000
+    ) / 1000
+    print 'Patched a %d byte record in %.2fus' % (len(buf), duration * 1e6)
+    ctr_patch(memoryview(buf), offset, 'A' * 12, admin_payload)
+    print oracle.admin_exists(str(buf))
+
+    # Patch many records at once
+    records = [bytearray(oracle.encrypt(oracle.PREFIX + 'A' * 64
+                                        + oracle.SUFFIX))
+               for _ in range(10000)]
+    patches = [(i, offset + i % 50, 'A' * 12, admin_payload)
+               for i in range(len(records))]
+    duration = timeit.timeit(lambda: ctr_patch_batch(records, patches),
+                             number=1)
+    print 'Applied %d patches in %.3fs' % (len(patches), duration)
+    print all(oracle.admin_exists(str(record)) for record in records)
@@ -32,6 +32,14 @@ As the attacker, recovering the plaintext from the error, extract the key:
 P'_1 XOR P'_3
 """
 
+import os
+import sys
+import timeit
+import numpy as np
+from multiprocessing.pool import ThreadPool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'misc'))
+from byteclass import is_plausible, is_plausible_batch
 from challenge25 import rand_bytes, xorstr, pkcs7_pad
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
@@ -43,9 +51,6 @@ class SessionOracle:
     """
 
     __BLOCKSIZE = 16
-    # Set of unused ASCII characters    
-    __UNUSED_SET = set(map(chr, list(range(0, 9) + range(11, 32) + [127]
-                                     + range(129, 153) + range(154, 161))))
 
     def __init__(self):
         # Establish a random 16-byte key and iv for the length of the "session"
@@ -63,47 +68,184 @@ class SessionOracle:
     def decrypt(self, ct):
         """
         Decrypts an input CT and raises an Exception if the decrypted PT is not
-        ASCII-compliant.
+        ASCII-compliant (see is_plausible()).
         """
         decryptor = self.__cipher.decryptor()
         pt = decryptor.update(ct) + decryptor.finalize()
-        #for c in pt:
-        #    if c in self.__UNUSED_SET:
-        #        raise Exception('Invalid input %s (returned %s)' % (ct, pt))
+        if not is_plausible(pt):
+            raise Exception('Invalid input %s (returned %s)' % (ct, pt))
         return pt
 
+def aes_cbc_encrypt(key, pt):
+    """
+    Encrypts @pt with AES 128 in CBC mode, using @key as the IV too (like the
+    oracle does). Pads as necessary using PKCS#7.
+
+    @param key [str]: ASCII key
+    @param pt [str]: ASCII PT
+    @returns [str]: ASCII CT
+    """
+
+    pt = pkcs7_pad(pt, 16)
+    cipher = Cipher(algorithms.AES(key),
+                    modes.CBC(key),
+                    backend=default_backend())
+    encryptor = cipher.encryptor()
+    return encryptor.update(pt) + encryptor.finalize()
+
+def aes_cbc_decrypt(key, ct):
+    """
+    Decrypts @ct with AES 128 in CBC mode, using @key as the IV too. The
+    padding is left on.
+
+    @param key [str]: ASCII key
+    @param ct [str]: ASCII CT
+    @returns [str]: ASCII PT (padded)
+    """
+
+    cipher = Cipher(algorithms.AES(key),
+                    modes.CBC(key),
+                    backend=default_backend())
+    decryptor = cipher.decryptor()
+    return decryptor.update(ct) + decryptor.finalize()
+
+def modify_ct(ct, blocksize=16):
+    """
+    @param ct [str]: CT of at least 3 blocks, C_1 || C_2 || C_3 || ...
+    @returns [str]: C_1 || 0 || C_1
+    """
+
+    return ct[:blocksize] + '\x00' * blocksize + ct[:blocksize]
+
+def leaked_pt(oracle, ct):
+    """
+    Decrypts @ct with the oracle. A noncompliant PT comes back in the error
+    message, 'Invalid input [ct] (returned [pt])', which is where the attacker
+    gets it from. Any other error (e.g. a network error from a remote oracle)
+    is raised again.
+
+    @param oracle [SessionOracle]: Oracle to decrypt with
+    @param ct [str]: ASCII CT
+    @returns [str]: The PT
+    """
+
+    prefix = 'Invalid input %s (returned ' % ct
+    try:
+        return oracle.decrypt(ct)
+    except Exception, e:
+        message = e.message if isinstance(e.message, str) else ''
+        if not (message.startswith(prefix) and message.endswith(')')):
+            raise
+        return message[len(prefix):-1]
+
 def recover_key(oracle):
+    """
+    Decrypting C_1 || 0 || C_1 gives P'_1 = D_k(C_1) XOR IV and
+    P'_3 = D_k(C_1) XOR 0, so P'_1 XOR P'_3 = IV = k.
+
+    @param oracle [SessionOracle]: Oracle to attack
+    @returns [str]: The session key
+    """
+
     blocksize = 16
     target_pt = 'A' * blocksize + 'B' * blocksize + 'C' * blocksize
-    target_ct = oracle.encrypt(target_pt)
-    target_ct_blocks = [target_ct[i:i+blocksize]
-                        for i in range(0, len(target_ct), blocksize)]
-    new_ct = target_ct_blocks[0] + '\x00' * blocksize + target_ct_blocks[0]
-    try:
-        new_pt = oracle.decrypt(new_ct)
-        new_pt_blocks = [new_pt[i:i+blocksize]
-                         for i in range(0, len(new_pt), blocksize)]
-        key = xorstr(new_pt_blocks[0], new_pt_blocks[2])
-        return key
-    except Exception, e:
-        print e
-        print e.message[-blocksize-1:-1].encode('hex')
+    new_pt = leaked_pt(oracle, modify_ct(oracle.encrypt(target_pt)))
+    return xorstr(new_pt[:blocksize], new_pt[2*blocksize:3*blocksize])
 
-def check_key(oracle, key):
+def recover_keys(oracles, workers=32):
+    """
+    Recovers the keys of many sessions at once (see recover_key()). Each
+    session needs one encryption and one decryption from its oracle, which
+    run on a pool of @workers threads (this pays off when the oracles are
+    remote, since the threads wait on the network concurrently). The
+    leaked PTs are then stacked into a matrix and every key is extracted in
+    a single vectorized XOR of the first and third block columns.
 
-    def aes_cbc_encrypt(key, pt):
-        pt = pkcs7_pad(pt, 16)
-        cipher = Cipher(algorithms.AES(key),
-                        modes.CBC(key),
-                        backend=default_backend())
-        encryptor = cipher.encryptor()
-        return encryptor.update(pt) + encryptor.finalize()
+    @param oracles [list]: Oracles (SessionOracle) to attack
+    @param workers [int]: Number of sessions to attack concurrently
+    @returns [list]: The session key of each oracle
+    """
+
+    def attack(oracle):
+        pt = leaked_pt(oracle, modify_ct(oracle.encrypt(target_pt)))
+        return pt[:3*blocksize]
 
+    blocksize = 16
+    target_pt = 'A' * blocksize + 'B' * blocksize + 'C' * blocksize
+    pool = ThreadPool(workers)
+    try:
+        pts = pool.map(attack, oracles)
+    finally:
+        pool.close()
+        pool.join()
+    pts = np.frombuffer(''.join(pts), dtype=np.uint8).reshape(len(oracles),
+                                                              3, blocksize)
+    keys = pts[:, 0] ^ pts[:, 2]
+    return [key.tostring() for key in keys]
+
+def check_key(oracle, key):
     check_pt = ('I been Steph Curry with the shot, Been cookin\' with the'
                 'sauce, chef, curry in the pot, boy')
     print 'CT with our key: %s' % aes_cbc_encrypt(key, check_pt).encode('hex')
     print 'Oracle CT:       %s' % oracle.encrypt(check_pt).encode('hex')
 
+def screen_keys(cts, keys, blocksize=16):
+    """
+    Checks recovered keys offline against CTs of unknown PTs (e.g. traffic
+    intercepted from each session): a wrong key decrypts its CT to noise, so
+    a key is only kept if its PT has valid PKCS#7 padding and no RARE or
+    UNUSED bytes (see misc/byteclass.py), checked for all keys at once.
+
+    @param cts [list]: A CT from each session
+    @param keys [list]: Recovered key for each session
+    @param blocksize [int]: Blocksize of the cipher
+    @returns [np.array]: Boolean array, True where the key is plausible
+    """
+
+    pts = [aes_cbc_decrypt(key, ct) for key, ct in zip(keys, cts)]
+    padlens = [ord(pt[-1]) for pt in pts]
+    padded = np.array([1 <= n <= blocksize and pt.endswith(pt[-1] * n)
+                       for pt, n in zip(pts, padlens)], dtype=bool)
+    unpadded = [pt[:-n] if ok else pt
+                for pt, n, ok in zip(pts, padlens, padded)]
+    return padded & is_plausible_batch(unpadded)
+
+def check_keys(oracles, keys, cts=None, workers=32):
+    """
+    Verifies many recovered keys at once: each oracle encrypts the same PT
+    (on a pool of @workers threads), which is encrypted locally with the
+    corresponding key, and the two CT matrices are compared in bulk. If a CT
+    from each session is given, keys failing screen_keys() are rejected
+    without querying their oracle.
+
+    @param oracles [list]: Oracles (SessionOracle)
+    @param keys [list]: Recovered key for each oracle
+    @param cts [list]: A CT of an unknown PT from each session (optional)
+    @param workers [int]: Number of oracles to query concurrently
+    @returns [np.array]: Boolean array, True where the key is correct
+    """
+
+    check_pt = ('I been Steph Curry with the shot, Been cookin\' with the'
+                'sauce, chef, curry in the pot, boy')
+    valid = (np.ones(len(keys), dtype=bool) if cts is None
+             else screen_keys(cts, keys))
+    idxs = np.flatnonzero(valid)
+    if not len(idxs):
+        return valid
+    pool = ThreadPool(workers)
+    try:
+        oracle_cts = pool.map(lambda i: oracles[i].encrypt(check_pt), idxs)
+    finally:
+        pool.close()
+        pool.join()
+    our_cts = [aes_cbc_encrypt(keys[i], check_pt) for i in idxs]
+    shape = (len(idxs), len(our_cts[0]))
+    valid[idxs] = np.all(np.frombuffer(''.join(oracle_cts), dtype=np.uint8)
+                         .reshape(shape)
+                         == np.frombuffer(''.join(our_cts), dtype=np.uint8)
+                         .reshape(shape), axis=1)
+    return valid
+
 if __name__=='__main__':
     oracle = SessionOracle()
     key = recover_key(oracle)
@@ -112,3 +254,17 @@ if __name__=='__main__':
     # Now that we have the key, we can encrypt a message and verify it against
     # the CT the oracle returns.
     check_key(oracle, key)
+
+    # Recover the keys of many sessions at once, screening them against
+    # traffic intercepted from each session before verifying them
+    oracles = [SessionOracle() for _ in range(5000)]
+    traffic = [oracle.encrypt('comment1=cooking%%20MCs;userdata=%d' % i)
+               for i, oracle in enumerate(oracles)]
+    start = timeit.default_timer()
+    keys = recover_keys(oracles)
+    keys[0] = rand_bytes(16) # A wrong key is screened out offline
+    valid = check_keys(oracles, keys, traffic)
+    duration = timeit.default_timer() - start
+    print '%d/%d keys verified in %.2fs (%.0f sessions/s)' % (
+        valid.sum(), len(oracles), duration, len(oracles) / duration
+    )